@@ -0,0 +1,76 @@
+"""CPU time per audio profile, on local sample files.
+
+Each AUDIO_PROFILES entry is run through the same yt-dlp post-processor a
+download uses (FFmpegExtractAudio), on an opus/webm source like YouTube's
+format 251 and an AAC/m4a one like format 140. Needs ffmpeg and ffprobe;
+FFMPEG_THREADS applies as it does on the server.
+
+    python bench/audio_profiles.py [--seconds 180]
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import time
+
+import harness
+import server
+
+SOURCES = {
+    "webm (opus)": ("webm", ["-c:a", "libopus", "-b:a", "160k"]),
+    "m4a (aac)": ("m4a", ["-c:a", "aac", "-b:a", "128k"]),
+}
+
+
+def make_source(folder, ext, codec_args, seconds):
+    path = os.path.join(folder, f"source.{ext}")
+    # Pink noise is about as hard to encode as music gets
+    subprocess.run([server.FFMPEG, "-v", "error", "-f", "lavfi", "-i",
+                    f"anoisesrc=color=pink:duration={seconds}:sample_rate=48000",
+                    "-ac", "2", *codec_args, path], check=True)
+    return path
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_profile(profile, source, folder):
+    from yt_dlp import YoutubeDL
+    from yt_dlp.postprocessor import FFmpegExtractAudioPP
+
+    ext = os.path.splitext(source)[1][1:]
+    path = os.path.join(folder, f"input.{ext}")
+    shutil.copyfile(source, path)
+    ydl = YoutubeDL({"quiet": True, "postprocessor_args": server.YT_DLP_PARAMS["audio"]["postprocessor_args"]})
+    pp = FFmpegExtractAudioPP(ydl, preferredcodec=profile["codec"], preferredquality=profile["quality"])
+    cpu, wall = children_cpu(), time.perf_counter()
+    files, info = pp.run({"filepath": path, "ext": ext})
+    cpu, wall = children_cpu() - cpu, time.perf_counter() - wall
+    for leftover in files + [info["filepath"]]:
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    return cpu, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=int, default=180, help="length of the sample audio")
+    args = parser.parse_args()
+    if not (shutil.which(server.FFMPEG) and shutil.which("ffprobe")):
+        raise SystemExit("needs ffmpeg and ffprobe on PATH")
+
+    folder = harness.scratch("audio")
+    print(f"{args.seconds}s samples, FFMPEG_THREADS={server.FFMPEG_THREADS or 'default'}")
+    print(f"{'source':<14}{'profile':<10}{'cpu s':>8}{'wall s':>8}{'x realtime':>12}")
+    for source_name, (ext, codec_args) in SOURCES.items():
+        source = make_source(folder, ext, codec_args, args.seconds)
+        for name, profile in server.AUDIO_PROFILES.items():
+            cpu, wall = run_profile(profile, source, folder)
+            print(f"{source_name:<14}{name:<10}{cpu:8.2f}{wall:8.2f}{args.seconds / wall:12.0f}")
+
+
+if __name__ == "__main__":
+    main()
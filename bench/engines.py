@@ -0,0 +1,84 @@
+"""Per-job overhead of the two download engines: DOWNLOAD_ENGINE=subprocess
+(a yt-dlp process per job) against DOWNLOAD_ENGINE=embedded (a warm
+YoutubeDL in a pool worker).
+
+Both go through server.fetch_media with the real yt-dlp. The stub is a local
+HTTP server handing out a tiny file under a new name for every job, which
+yt-dlp's generic extractor takes as a direct download. Nothing is
+transcoded, so what's left is the engine's own cost: for the subprocess
+engine that's interpreter startup and importing the extractors every time.
+The embedded pool's first job (spawning and warming the worker) is shown on
+its own.
+
+    python bench/engines.py [--jobs 20]
+"""
+import argparse
+import itertools
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import harness
+import server
+
+CLIP = os.urandom(64 * 1024)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.send_headers()
+
+    def do_GET(self):
+        self.send_headers()
+        self.wfile.write(CLIP)
+
+    def send_headers(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(len(CLIP)))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def run_jobs(engine, base, ids, jobs):
+    server.DOWNLOAD_ENGINE = engine
+    folder = harness.scratch(engine)
+    samples = []
+    for _ in range(jobs):
+        # A new file name each time, so yt-dlp never finds the last one done
+        url = f"{base}/clip{next(ids):06d}.mp4"
+        start = time.perf_counter()
+        server.fetch_media("video", url, folder)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=20)
+    args = parser.parse_args()
+
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    stub.daemon_threads = True
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{stub.server_address[1]}"
+    ids = itertools.count()
+    try:
+        subprocess_median = harness.report(
+            "subprocess engine, per job", run_jobs("subprocess", base, ids, args.jobs))
+        first = run_jobs("embedded", base, ids, 1)
+        harness.report("embedded engine, first job (pool start)", first)
+        embedded_median = harness.report(
+            "embedded engine, per job (warm)", run_jobs("embedded", base, ids, args.jobs))
+        print(f"warm embedded jobs are {subprocess_median / embedded_median:.0f}x cheaper")
+    finally:
+        stub.shutdown()
+        if server._embedded_pool is not None:
+            server._embedded_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
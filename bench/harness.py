@@ -0,0 +1,40 @@
+"""Shared setup for the benchmarks in this folder.
+
+Run them from anywhere, e.g. ``python bench/listing.py``. Importing this
+points HOME at a scratch directory first (server.py creates its folders
+under ~ at import time), so a benchmark never touches real state.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ["HOME"] = tempfile.mkdtemp(prefix="mp3server-bench-")
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+def scratch(name):
+    """A fresh folder under the scratch HOME"""
+    return tempfile.mkdtemp(prefix=f"{name}-", dir=os.environ["HOME"])
+
+
+def measure(fn, repeat=200, warmup=5):
+    """Seconds per call of fn, one sample per call"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, samples, unit=1000, suffix="ms"):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{name:<40} median {statistics.median(samples) * unit:8.3f} {suffix}"
+          f"   p95 {p95 * unit:8.3f} {suffix}   n={len(samples)}")
+    return statistics.median(samples)
@@ -0,0 +1,55 @@
+"""/files response times on a 50k-entry screenshots folder.
+
+The target is under 10ms per warm (cached) page, for every sort. The cold
+line is the first request, which scans the folder.
+
+    python bench/listing.py [--entries 50000]
+"""
+import argparse
+import os
+import time
+
+import harness
+import server
+
+TARGET = 0.010
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=50000)
+    args = parser.parse_args()
+
+    root = harness.scratch("Pictures")
+    folder = os.path.join(root, "Screenshots")
+    os.mkdir(folder)
+    for i in range(args.entries):
+        open(os.path.join(folder, f"Screenshot {i:06d}.png"), "w").close()
+    server.SCREENSHOTS_FOLDER = root
+    server.RATE_LIMITS = {"cheap": (0, 0), "expensive": (0, 0)}
+    client = server.app.test_client()
+
+    def page(query):
+        response = client.get(f"/files/Screenshots?{query}")
+        assert response.status_code == 200, response.status_code
+        return response
+
+    start = time.perf_counter()
+    page("format=json")
+    print(f"cold scan of {args.entries} entries: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    worst = 0
+    for sort in server.LISTING_SORTS:
+        for order in ("asc", "desc"):
+            query = f"format=json&sort={sort}&order={order}"
+            worst = max(worst, harness.report(f"json {sort} {order}, first page", harness.measure(lambda: page(query))))
+            cursor = page(query).get_json()["nextCursor"]
+            worst = max(worst, harness.report(f"json {sort} {order}, next page",
+                                              harness.measure(lambda: page(f"{query}&cursor={cursor}"))))
+    worst = max(worst, harness.report("html name asc, first page", harness.measure(lambda: page(""))))
+    print(f"slowest median {worst * 1000:.2f} ms: {'ok' if worst < TARGET else 'over'} the {TARGET * 1000:.0f} ms target")
+    raise SystemExit(0 if worst < TARGET else 1)
+
+
+if __name__ == "__main__":
+    main()
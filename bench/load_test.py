@@ -0,0 +1,123 @@
+"""Load test for `server.py serve` with 1, 2 and 4 worker processes, using
+the fake yt-dlp from tests/.
+
+Each run starts a fresh server (own HOME) and measures:
+
+- jobs/s: --jobs distinct URLs submitted at once, polled until all are
+  done. A job runs in the worker process that accepted its submission,
+  AUDIO_WORKERS at a time per process, so this scales with the worker count
+  as far as the kernel spreads the submissions; the share each process took
+  is printed alongside.
+- requests/s: --clients threads polling /jobs/<id> for --seconds, which is
+  CPU-bound in Python and scales with workers up to the number of cores.
+
+    python bench/load_test.py [--workers 1 2 4] [--jobs 48] [--delay 0.5]
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import harness
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def call(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)
+
+
+def start_server(workers, delay):
+    home = harness.scratch(f"serve-{workers}")
+    port = free_port()
+    env = dict(os.environ, HOME=home, YT_DLP=os.path.join(harness.REPO, "tests", "fake-yt-dlp"),
+               FAKE_DELAY=str(delay), MUSIC_IMPORT_FOLDER=home, DISK_MIN_FREE_BYTES="0",
+               CHEAP_RATE="0", EXPENSIVE_RATE="0", JOB_QUEUE_SIZE="1000", CLIENT_QUEUE_SIZE="1000",
+               LOG_LEVEL="WARNING")
+    proc = subprocess.Popen([sys.executable, os.path.join(harness.REPO, "server.py"), "serve",
+                             "--bind", f"127.0.0.1:{port}", "--workers", str(workers)],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while True:
+        try:
+            urllib.request.urlopen(base + "/", timeout=1).close()
+            return proc, base, home
+        except OSError:
+            if time.time() > deadline or proc.poll() is not None:
+                proc.kill()
+                raise SystemExit(f"server with {workers} workers didn't start")
+            time.sleep(0.1)
+
+
+def run(workers, jobs, delay, clients, seconds):
+    proc, base, home = start_server(workers, delay)
+    polls = 0
+    try:
+        urls = ["https://youtu.be/" + uuid.uuid4().hex[:11] for _ in range(jobs)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            job_ids = list(pool.map(lambda url: call(base + "/download", {"url": url})["job"], urls))
+        pending = set(job_ids)
+        while pending:
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                states = dict(zip(pending, pool.map(lambda i: call(f"{base}/jobs/{i}")["state"], pending)))
+            polls += len(states)
+            failed = [i for i, state in states.items() if state == "error"]
+            if failed:
+                raise SystemExit(f"{len(failed)} jobs failed, e.g. {call(f'{base}/jobs/{failed[0]}')}")
+            pending = {i for i, state in states.items() if state != "done"}
+            time.sleep(0.25)
+        elapsed = time.perf_counter() - start
+
+        def poll_until(deadline):
+            count = 0
+            while time.perf_counter() < deadline:
+                call(f"{base}/jobs/{job_ids[count % len(job_ids)]}")
+                count += 1
+            return count
+
+        deadline = time.perf_counter() + seconds
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            requests = sum(pool.map(poll_until, [deadline] * clients))
+    finally:
+        proc.terminate()
+        proc.wait()
+    with sqlite3.connect(os.path.join(home, ".mp3-conversions-server", "jobs.sqlite3")) as db:
+        shares = sorted((n for (n,) in db.execute("SELECT COUNT(*) FROM jobs GROUP BY owner")), reverse=True)
+    return elapsed, requests / seconds, shares
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--jobs", type=int, default=48)
+    parser.add_argument("--delay", type=float, default=0.5, help="seconds per fake download")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.jobs} jobs, {args.delay:g} s per fake download; {args.clients} polling clients; "
+          f"{os.cpu_count()} CPUs")
+    for workers in args.workers:
+        elapsed, request_rate, shares = run(workers, args.jobs, args.delay, args.clients, args.seconds)
+        print(f"{workers} workers: {args.jobs / elapsed:6.1f} jobs/s  {request_rate:7.0f} requests/s"
+              f"  jobs per process {'/'.join(map(str, shares))}")
+
+
+if __name__ == "__main__":
+    main()
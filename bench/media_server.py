@@ -0,0 +1,108 @@
+"""A local HTTP server with fake HLS and DASH streams for the video benchmarks.
+
+Every response waits out a fixed latency and is then sent at a capped rate
+per connection, like a CDN edge far away: one connection can't use the whole
+link, so fragment concurrency shows up in the download rate.
+
+    /hls/video.m3u8       HLS media playlist of SEGMENTS MPEG-TS segments
+    /dash/manifest.mpd    DASH manifest, separate video and audio segments
+
+Segment bodies are random bytes; the downloaders only concatenate them.
+"""
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEGMENTS = 40
+SEGMENT_SECONDS = 4
+CHUNK = 16 * 1024
+
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, segment_bytes=256 * 1024, latency=0.05, rate=2 * 1024 * 1024):
+        super().__init__(("127.0.0.1", 0), MediaHandler)
+        self.segment = os.urandom(segment_bytes)
+        self.latency = latency
+        self.rate = rate
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def hls_playlist():
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{SEGMENT_SECONDS}",
+             "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    for i in range(SEGMENTS):
+        lines += [f"#EXTINF:{SEGMENT_SECONDS}.0,", f"seg{i}.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def dash_manifest():
+    duration = SEGMENTS * SEGMENT_SECONDS
+
+    def representation(kind, attrs):
+        segments = "".join(f'<SegmentURL media="{kind}/seg{i}.m4s"/>' for i in range(SEGMENTS))
+        return (f'<Representation id="{kind}" {attrs}>'
+                f'<SegmentList timescale="1" duration="{SEGMENT_SECONDS}">'
+                f'<Initialization sourceURL="{kind}/init.mp4"/>{segments}</SegmentList></Representation>')
+
+    return (
+        '<?xml version="1.0"?>'
+        '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" '
+        f'mediaPresentationDuration="PT{duration}S" minBufferTime="PT2S" '
+        'profiles="urn:mpeg:dash:profile:isoff-on-demand:2011"><Period>'
+        '<AdaptationSet mimeType="video/mp4" contentType="video">'
+        + representation("video", 'codecs="avc1.64001f" bandwidth="2000000" width="1280" height="720"')
+        + '</AdaptationSet><AdaptationSet mimeType="audio/mp4" contentType="audio" lang="en">'
+        + representation("audio", 'codecs="mp4a.40.2" bandwidth="128000" audioSamplingRate="48000"')
+        + "</AdaptationSet></Period></MPD>"
+    )
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/hls/video.m3u8":
+            self.reply(hls_playlist().encode(), "application/vnd.apple.mpegurl")
+        elif path == "/dash/manifest.mpd":
+            self.reply(dash_manifest().encode(), "application/dash+xml")
+        elif path.startswith(("/hls/seg", "/dash/video/", "/dash/audio/")):
+            self.reply(self.server.segment, "video/mp2t" if path.endswith(".ts") else "video/mp4")
+        else:
+            self.send_error(404)
+
+    def reply(self, body, content_type):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        # Paced writes: rate bytes per second on this connection
+        start = time.perf_counter()
+        for offset in range(0, len(body), CHUNK):
+            self.wfile.write(body[offset:offset + CHUNK])
+            ahead = (offset + CHUNK) / self.server.rate - (time.perf_counter() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def log_message(self, format, *args):
+        pass
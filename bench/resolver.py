@@ -0,0 +1,74 @@
+"""Syscalls and time to check and open one screenshot: the original
+realpath()/startswith() checks against open_screenshot().
+
+    python bench/resolver.py
+"""
+import builtins
+import collections
+import os
+
+import harness
+import server
+
+COUNTED = ("stat", "lstat", "fstat", "open", "readlink", "close")
+
+
+def legacy_open(rel_path):
+    # What download_file did before the resolver: realpath both sides, then
+    # exists/isdir/getsize, then open the path again to send it
+    full_path = os.path.realpath(os.path.join(server.SCREENSHOTS_FOLDER, rel_path))
+    if not full_path.startswith(os.path.realpath(server.SCREENSHOTS_FOLDER)):
+        raise PermissionError(rel_path)
+    if not os.path.exists(full_path) or os.path.isdir(full_path):
+        raise FileNotFoundError(rel_path)
+    os.path.getsize(full_path)
+    open(full_path, "rb").close()
+
+
+def resolver_open(rel_path):
+    _, _, fd = server.open_screenshot(rel_path)
+    os.fdopen(fd, "rb").close()
+
+
+def count_syscalls(fn, *args):
+    counts = collections.Counter()
+    originals = {name: getattr(os, name) for name in COUNTED}
+    real_open = builtins.open
+
+    def counting(name, call):
+        def wrapper(*a, **kw):
+            counts[name] += 1
+            return call(*a, **kw)
+        return wrapper
+
+    for name, call in originals.items():
+        setattr(os, name, counting(name, call))
+    builtins.open = counting("open", real_open)
+    try:
+        fn(*args)
+    finally:
+        for name, call in originals.items():
+            setattr(os, name, call)
+        builtins.open = real_open
+    return counts
+
+
+def main():
+    root = os.path.join(os.environ["HOME"], "Pictures")
+    rel_path = "2024/10/Screenshots/Screenshot 2024-10-01 at 12.00.00.png"
+    os.makedirs(os.path.dirname(os.path.join(root, rel_path)), exist_ok=True)
+    with open(os.path.join(root, rel_path), "wb") as f:
+        f.write(b"\0" * 4096)
+    server.SCREENSHOTS_FOLDER = root
+    server.screenshots_root()
+
+    for name, fn in (("realpath + exists/isdir/getsize", legacy_open),
+                     ("open_screenshot", resolver_open)):
+        counts = count_syscalls(fn, rel_path)
+        detail = ", ".join(f"{call} {n}" for call, n in sorted(counts.items()))
+        print(f"{name:<40} {sum(counts.values()):3d} calls ({detail})")
+        harness.report(name, harness.measure(lambda: fn(rel_path), repeat=5000), unit=1e6, suffix="us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""MP4 download rate against a local fake stream (bench/media_server.py):
+fixed fragment concurrency against the per-host adaptive tuning.
+
+The server paces every connection, so the rate should grow with concurrency
+until the link (or MAX_CONNECTIONS) is the limit, and the tuning should
+climb to there over a few downloads. DASH needs ffmpeg for the merge, as
+does VIDEO_DOWNLOADER=ffmpeg.
+
+    python bench/video_fragments.py [--stream hls|dash] [--downloader native|aria2c|ffmpeg]
+"""
+import argparse
+import os
+import time
+
+import harness
+import server
+from media_server import MediaServer
+
+STREAMS = {"hls": "/hls/video.m3u8", "dash": "/dash/manifest.mpd"}
+
+
+def download(url):
+    folder = harness.scratch("video")
+    start = time.perf_counter()
+    _, file_path = server.fetch_video(url, folder)
+    elapsed = time.perf_counter() - start
+    return os.path.getsize(file_path) / elapsed / 2**20, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stream", choices=STREAMS, default="hls")
+    parser.add_argument("--downloader", choices=("native", "aria2c", "ffmpeg"), default="native")
+    parser.add_argument("--rate", type=float, default=2, help="MiB/s per connection")
+    parser.add_argument("--segment-kib", type=int, default=512)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before each response")
+    parser.add_argument("--adaptive-runs", type=int, default=6)
+    args = parser.parse_args()
+
+    server.DOWNLOAD_ENGINE = "subprocess"
+    server.VIDEO_DOWNLOADER = args.downloader
+
+    with MediaServer(segment_bytes=args.segment_kib * 1024, latency=args.latency,
+                     rate=int(args.rate * 2**20)) as media:
+        url = media.url + STREAMS[args.stream]
+        print(f"{args.stream}, {args.downloader} downloader, {args.rate:g} MiB/s per connection, "
+              f"{args.latency * 1000:.0f} ms latency, MAX_CONNECTIONS={server.MAX_CONNECTIONS}")
+
+        tuning = (server.FRAGMENT_CONCURRENCY, server.FRAGMENT_CONCURRENCY_MIN, server.FRAGMENT_CONCURRENCY_MAX)
+        for n in (1, 4, 8, 16):
+            server.FRAGMENT_CONCURRENCY = server.FRAGMENT_CONCURRENCY_MIN = server.FRAGMENT_CONCURRENCY_MAX = n
+            server._fragment_tuning.clear()
+            rate, elapsed = download(url)
+            print(f"fixed    -N {n:<3} {rate:7.1f} MiB/s  {elapsed:6.2f} s")
+
+        server.FRAGMENT_CONCURRENCY, server.FRAGMENT_CONCURRENCY_MIN, server.FRAGMENT_CONCURRENCY_MAX = tuning
+        server._fragment_tuning.clear()
+        for run in range(1, args.adaptive_runs + 1):
+            n = server.fragment_concurrency("127.0.0.1")
+            rate, elapsed = download(url)
+            print(f"adaptive run {run}: -N {n:<3} {rate:7.1f} MiB/s  {elapsed:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
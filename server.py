@@ -1,4 +1,14 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, Response, g, has_request_context
+from werkzeug.security import safe_join
+from werkzeug.wsgi import FileWrapper
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails are disabled without Pillow
+    Image = None
+try:
+    import brotli
+except ImportError:  # pages are served gzip-only without it
+    brotli = None
 import os
 import subprocess
 import uuid
@@ -6,6 +16,36 @@ import re
 import shutil
 from datetime import datetime
 import json
+import sys
+import queue
+import threading
+import time
+import multiprocessing
+import collections
+import errno
+import base64
+import bisect
+import mimetypes
+import hashlib
+import gzip
+import zlib
+import zipfile
+import heapq
+import itertools
+import contextlib
+import ctypes
+import functools
+import logging
+import logging.handlers
+import atexit
+import tempfile
+import fcntl
+import stat
+import sqlite3
+import urllib.parse
+import html
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 DOWNLOAD_FOLDER = os.path.expanduser("~/Desktop/songs")
@@ -17,154 +57,2347 @@ os.makedirs(VIDEO_DOWNLOAD_FOLDER, exist_ok=True)
 # Define the restricted screenshots folder path
 SCREENSHOTS_FOLDER = os.path.expanduser("~/Pictures")
 
+# Server state (indexes, caches) lives outside the download folders
+STATE_FOLDER = os.path.expanduser(os.environ.get("STATE_FOLDER", "~/.mp3-conversions-server"))
+os.makedirs(STATE_FOLDER, exist_ok=True)
+
+# Apple Music's auto-import folder, and how finished MP3s get there:
+# "hardlink", "reflink" (copy-on-write clone where the filesystem supports
+# it), "rename" (moves the file out of DOWNLOAD_FOLDER) or "copy". Anything
+# but "copy" falls back to copying when the folders are on different
+# filesystems or the filesystem can't do it.
+MUSIC_IMPORT_FOLDER = os.path.expanduser(os.environ.get(
+    "MUSIC_IMPORT_FOLDER",
+    "/Users/jamilkhalaf/Music/Music/Media.localized/Automatically Add to Music.localized"))
+MUSIC_IMPORT_STRATEGY = os.environ.get("MUSIC_IMPORT_STRATEGY", "hardlink")
+
+# Download job queue: how many downloads of each kind run at once, and how
+# many may wait before new submissions are rejected with a 429
+AUDIO_WORKERS = int(os.environ.get("AUDIO_WORKERS", "2"))
+VIDEO_WORKERS = int(os.environ.get("VIDEO_WORKERS", "1"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "32"))
+JOB_HISTORY_LIMIT = int(os.environ.get("JOB_HISTORY_LIMIT", "500"))
+# Finished jobs older than this are compacted out of the job store
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", str(7 * 86400)))
+# Job and batch records are mirrored here so every server worker process
+# sees the same jobs
+JOBS_DB = os.path.join(STATE_FOLDER, "jobs.sqlite3")
+# Each server process holds a lock on a file here for as long as it lives;
+# jobs record the token of the process that owns them
+INSTANCES_FOLDER = os.path.join(STATE_FOLDER, "instances")
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+# Queued jobs are taken in fair order across clients (weighted by API key,
+# see API_KEYS), and one client may have at most CLIENT_QUEUE_SIZE waiting
+CLIENT_QUEUE_SIZE = int(os.environ.get("CLIENT_QUEUE_SIZE", "8"))
+
+# Token-bucket rate limits per client: requests per second and burst size
+# for cheap routes (listings, file serving, job status) and expensive ones
+# (anything that runs yt-dlp or ffmpeg). A rate of 0 turns a limit off.
+# RATE_LIMIT_STORE "sqlite" shares buckets between server worker processes.
+RATE_LIMITS = {
+    "cheap": (float(os.environ.get("CHEAP_RATE", "20")), float(os.environ.get("CHEAP_BURST", "100"))),
+    "expensive": (float(os.environ.get("EXPENSIVE_RATE", "0.2")), float(os.environ.get("EXPENSIVE_BURST", "10"))),
+}
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_DB = os.path.join(STATE_FOLDER, "rate-limits.sqlite3")
+# Clients sending X-API-Key with one of these get their own budget instead of
+# their address's, and a scheduling weight: "key1=4,key2" (default weight 1)
+API_KEYS = {}
+for _entry in filter(None, os.environ.get("API_KEYS", "").split(",")):
+    _key, _, _weight = _entry.strip().partition("=")
+    API_KEYS[_key] = float(_weight or 1)
+
+# Directory listings for /files are cached per directory (invalidated when
+# its mtime changes) and served a page at a time
+LISTING_CACHE_SIZE = int(os.environ.get("LISTING_CACHE_SIZE", "64"))
+LISTING_PAGE_SIZE = int(os.environ.get("LISTING_PAGE_SIZE", "200"))
+LISTING_MAX_PAGE_SIZE = 5000
+
+# Search index over the download and screenshots folders (SQLite FTS5),
+# kept current by rescanning directories whose mtime changed
+SEARCH_DB = os.path.join(STATE_FOLDER, "search.sqlite3")
+SEARCH_SCAN_INTERVAL = float(os.environ.get("SEARCH_SCAN_INTERVAL", "60"))
+# The first search in a process waits up to this long for the catch-up scan
+SEARCH_CATCH_UP_WAIT = float(os.environ.get("SEARCH_CATCH_UP_WAIT", "5"))
+SEARCH_PAGE_SIZE = 50
+# Relevance ranking scores every match, so queries matching more files than
+# this list the most recently indexed matches first instead
+SEARCH_RANK_LIMIT = int(os.environ.get("SEARCH_RANK_LIMIT", "2000"))
+SEARCH_MAX_PAGE_SIZE = 500
+
+# Bulk downloads from /files are streamed as ZIP archives built on the fly.
+# Formats that are already compressed are stored as-is.
+ZIP_MAX_FILES = int(os.environ.get("ZIP_MAX_FILES", "5000"))
+ZIP_STORED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".heic", ".mp3", ".m4a", ".opus", ".mp4",
+    ".mov", ".webm", ".mkv", ".zip", ".gz",
+}
+
+# Disk janitor. Only files the server downloaded (the media cache index is
+# the manifest) are ever removed; per-folder quotas are 0 = unlimited.
+# Downloads are refused while a folder's disk has less than
+# DISK_MIN_FREE_BYTES free.
+JANITOR_INTERVAL = float(os.environ.get("JANITOR_INTERVAL", "300"))
+# Files served or looked up this recently are never evicted
+JANITOR_GRACE = float(os.environ.get("JANITOR_GRACE", "600"))
+DISK_MIN_FREE_BYTES = int(os.environ.get("DISK_MIN_FREE_BYTES", str(2 * 1024 ** 3)))
+FOLDER_QUOTAS = {
+    DOWNLOAD_FOLDER: {
+        "max_bytes": int(os.environ.get("SONGS_MAX_BYTES", "0")),
+        "max_files": int(os.environ.get("SONGS_MAX_FILES", "0")),
+        "max_age_days": float(os.environ.get("SONGS_MAX_AGE_DAYS", "0")),
+    },
+    VIDEO_DOWNLOAD_FOLDER: {
+        "max_bytes": int(os.environ.get("VIDEOS_MAX_BYTES", "0")),
+        "max_files": int(os.environ.get("VIDEOS_MAX_FILES", "0")),
+        "max_age_days": float(os.environ.get("VIDEOS_MAX_AGE_DAYS", "0")),
+    },
+}
+
+# Thumbnails for the /files browser: generated on first request in a process
+# pool and kept in an LRU-evicted disk cache
+THUMB_FOLDER = os.path.join(STATE_FOLDER, "thumbs")
+THUMB_WORKERS = int(os.environ.get("THUMB_WORKERS", "2"))
+THUMB_CACHE_MAX_BYTES = int(os.environ.get("THUMB_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+THUMB_SIZES = (128, 256, 512)
+THUMB_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+
+# yt-dlp and ffmpeg executables (override to point at a specific install)
+YT_DLP = os.environ.get("YT_DLP", "yt-dlp")
+FFMPEG = os.environ.get("FFMPEG", "ffmpeg")
+
+# Output profiles for audio downloads. quality is yt-dlp's --audio-quality:
+# 0-10 is VBR (0 best), a bitrate in kbps like "320" is CBR. The source format
+# prefers one already in the target codec, so yt-dlp only remuxes it
+# instead of decoding and re-encoding. music says whether Apple Music can
+# import the result; it won't take opus, so those files are only saved.
+AUDIO_PROFILES = {
+    "mp3": {"codec": "mp3", "quality": "0", "source": "bestaudio[acodec=mp3]/bestaudio/best", "music": True},
+    "mp3-v2": {"codec": "mp3", "quality": "2", "source": "bestaudio[acodec=mp3]/bestaudio/best", "music": True},
+    "mp3-320": {"codec": "mp3", "quality": "320", "source": "bestaudio[acodec=mp3]/bestaudio/best", "music": True},
+    "mp3-192": {"codec": "mp3", "quality": "192", "source": "bestaudio[acodec=mp3]/bestaudio/best", "music": True},
+    "m4a": {"codec": "m4a", "quality": "0", "source": "bestaudio[acodec^=mp4a]/bestaudio/best", "music": True},
+    "opus": {"codec": "opus", "quality": "0", "source": "bestaudio[acodec=opus]/bestaudio/best", "music": False},
+}
+AUDIO_PROFILE = os.environ.get("AUDIO_PROFILE", "mp3")
+if AUDIO_PROFILE not in AUDIO_PROFILES:
+    AUDIO_PROFILE = "mp3"
+# ffmpeg encoder threads (0 = ffmpeg's default) and niceness for transcodes
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", "0"))
+FFMPEG_NICE = int(os.environ.get("FFMPEG_NICE", "0"))
+
+# Read size for streamed transcodes; this bounds memory per stream
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Block size when a file has to be read through Python (servers without a
+# sendfile-capable wsgi.file_wrapper, e.g. the Flask development server)
+FILE_CHUNK_SIZE = 256 * 1024
+FILE_CACHE_CONTROL = "private, max-age=3600"
+# Listing pages version thumbnail URLs with the source's mtime and size, so
+# the bytes behind one URL never change
+THUMB_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+# The HTML pages are compressed once at startup; browsers revalidate them
+# by ETag after PAGE_MAX_AGE seconds
+PAGE_MAX_AGE = int(os.environ.get("PAGE_MAX_AGE", "86400"))
+# Opt-in gzip for other text responses: whole bodies of at least
+# COMPRESS_MIN_SIZE bytes, and streamed ones (NDJSON, SSE) chunk by chunk
+COMPRESS_RESPONSES = os.environ.get("COMPRESS_RESPONSES", "0") == "1"
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_MIMETYPES = {"text/html", "text/plain", "application/json",
+                      "application/x-ndjson", "text/event-stream"}
+
+# Structured JSON logs, one object per line. Records are formatted on the
+# calling thread and written by a background listener thread.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE")  # stderr when unset
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY", "100"))
+
+# Each worker process snapshots its metrics here so /metrics on any worker
+# can report totals for the whole server
+METRICS_FOLDER = os.path.join(STATE_FOLDER, "metrics")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+# Minimum seconds between progress events of the same stage for a download
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "0.5"))
+
+# "subprocess" runs the yt-dlp executable per download, "embedded" drives
+# yt_dlp.YoutubeDL inside a pool of long-lived worker processes
+DOWNLOAD_ENGINE = os.environ.get("DOWNLOAD_ENGINE", "subprocess")
+EMBEDDED_WORKERS = int(os.environ.get("EMBEDDED_WORKERS", str(AUDIO_WORKERS + VIDEO_WORKERS)))
+
+# MP4 downloads. Fragment concurrency starts at FRAGMENT_CONCURRENCY and is
+# tuned per host from measured throughput, within the bounds below; all
+# video downloads in every server process share MAX_CONNECTIONS, one lock
+# file per connection in CONNECTIONS_FOLDER. VIDEO_DOWNLOADER is
+# yt-dlp's "native" downloader, "aria2c", or "ffmpeg", which fetches the
+# video and audio streams together and muxes while they arrive instead of
+# merging after both are complete.
+VIDEO_FORMAT = os.environ.get("VIDEO_FORMAT", "bv*+ba/best")
+VIDEO_DOWNLOADER = os.environ.get("VIDEO_DOWNLOADER", "native")
+FRAGMENT_CONCURRENCY = int(os.environ.get("FRAGMENT_CONCURRENCY", "8"))
+FRAGMENT_CONCURRENCY_MIN = 1
+FRAGMENT_CONCURRENCY_MAX = int(os.environ.get("FRAGMENT_CONCURRENCY_MAX", "32"))
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "32"))
+CONNECTIONS_FOLDER = os.path.join(STATE_FOLDER, "connections")
+
+# Finished downloads are indexed by canonical media key so repeat requests
+# skip yt-dlp entirely. Past MEDIA_CACHE_MAX_BYTES (0 = unlimited) the least
+# recently used files are deleted.
+MEDIA_CACHE_DB = os.path.join(STATE_FOLDER, "media-cache.sqlite3")
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", "0"))
+
+# Extractor metadata for /info, keyed by canonical media id and kept in the
+# same database for INFO_CACHE_TTL seconds. The most recent INFO_CACHE_SIZE
+# entries are also held in memory; at most INFO_CACHE_MAX_ROWS are stored.
+INFO_CACHE_TTL = float(os.environ.get("INFO_CACHE_TTL", "3600"))
+INFO_CACHE_SIZE = int(os.environ.get("INFO_CACHE_SIZE", "256"))
+INFO_CACHE_MAX_ROWS = int(os.environ.get("INFO_CACHE_MAX_ROWS", "10000"))
+
 def sanitize_filename(name):
     return re.sub(r'[^\w\-_\. ]', '_', name)
 
-def download_audio(url):
-    # Use yt-dlp to extract title first
-    title_cmd = [
-        "yt-dlp",
-        "--get-title",
-        "--no-warnings",
-        url
-    ]
-    try:
-        title_result = subprocess.run(title_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        raw_title = title_result.stdout.decode().strip()
-        safe_title = sanitize_filename(raw_title) + ".mp3"
-    except subprocess.CalledProcessError as e:
-        raise Exception("Failed to retrieve title")
+log = logging.getLogger("mp3server")
+# Per-thread context added to every record (the job a worker is running)
+LOG_CONTEXT = threading.local()
+_STANDARD_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+        }
+        for field, value in vars(record).items():
+            if field not in _STANDARD_RECORD_FIELDS and value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class LogContextFilter(logging.Filter):
+    def filter(self, record):
+        # Runs on the thread that logged, before the record is queued for the
+        # listener thread, so the request's g and LOG_CONTEXT are still readable
+        if has_request_context():
+            record.request_id = g.get("request_id")
+        record.job_id = getattr(LOG_CONTEXT, "job_id", None)
+        return True
+
+_log_pid = None
+_log_setup_lock = threading.Lock()
+
+def ensure_logging():
+    """Start this process's log listener. Checked per process so a worker
+    forked from a preloading master gets its own listener thread."""
+    global _log_pid
+    if _log_pid == os.getpid():
+        return
+    with _log_setup_lock:
+        if _log_pid == os.getpid():
+            return
+        records = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(records)
+        handler.setFormatter(JsonFormatter())
+        handler.addFilter(LogContextFilter())
+        output = logging.FileHandler(LOG_FILE) if LOG_FILE else logging.StreamHandler(sys.stderr)
+        output.setFormatter(logging.Formatter("%(message)s"))
+        listener = logging.handlers.QueueListener(records, output)
+        listener.start()
+        atexit.register(listener.stop)
+        log.handlers = [handler]
+        log.setLevel(LOG_LEVEL)
+        log.propagate = False
+        _log_pid = os.getpid()
+
+_log_sample_counts = collections.Counter()
+
+def log_sampled(level, key, msg, *args, **kwargs):
+    """Log only one in LOG_SAMPLE_EVERY messages for key (for hot loops)"""
+    _log_sample_counts[key] += 1
+    if (_log_sample_counts[key] - 1) % max(LOG_SAMPLE_EVERY, 1) == 0:
+        kwargs.setdefault("extra", {})["sample_rate"] = LOG_SAMPLE_EVERY
+        log.log(level, msg, *args, **kwargs)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf"))
+
+METRICS = {
+    "http_requests_total": ("counter", "HTTP requests by route, method and status class"),
+    "http_request_seconds": ("histogram", "Time to produce a response (streamed bodies excluded)"),
+    "file_bytes_served_total": ("counter", "File body bytes sent by route"),
+    "stage_seconds": ("histogram", "Time spent in each download stage"),
+    "jobs_total": ("counter", "Finished download jobs by kind and outcome"),
+    "job_queue_wait_seconds": ("histogram", "Time jobs spent queued before a worker picked them up"),
+    "job_queue_depth": ("gauge", "Jobs waiting in the queue"),
+    "active_subprocesses": ("gauge", "Running yt-dlp/ffmpeg processes"),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result (hit or miss)"),
+    "rate_limited_total": ("counter", "Requests rejected by the rate limiter, by budget"),
+    "fragment_concurrency": ("gauge", "Fragment concurrency the next video download from a host will use"),
+    "download_connections": ("gauge", "Connections held by running video downloads"),
+}
+
+_metrics_lock = threading.Lock()
+# (name, sorted label pairs) -> value; histograms hold [bucket counts..., sum]
+_metric_values = {}
+_metrics_flusher = None
+
+def metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    key = metric_key(name, labels)
+    with _metrics_lock:
+        _metric_values[key] = _metric_values.get(key, 0) + value
+
+def observe(name, value, **labels):
+    key = metric_key(name, labels)
+    with _metrics_lock:
+        values = _metric_values.get(key)
+        if values is None:
+            values = _metric_values[key] = [0] * (len(LATENCY_BUCKETS) + 1)
+        values[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        values[-1] += value
+
+@contextlib.contextmanager
+def timed(stage, kind):
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        observe("stage_seconds", time.perf_counter() - start, stage=stage, kind=kind, outcome=outcome)
+
+@contextlib.contextmanager
+def tracked_process(tool):
+    inc("active_subprocesses", tool=tool)
+    try:
+        yield
+    finally:
+        inc("active_subprocesses", -1, tool=tool)
+
+def metrics_snapshot():
+    with _metrics_lock:
+        snapshot = [[name, list(labels), value] for (name, labels), value in _metric_values.items()]
+    # Queue depth is read live rather than counted
+    for kind, jobs in JOB_QUEUES.items():
+        snapshot.append(["job_queue_depth", [["kind", kind]], jobs.qsize()])
+    with _fragment_tuning_lock:
+        for host, tuning in _fragment_tuning.items():
+            snapshot.append(["fragment_concurrency", [["host", host]], tuning["n"]])
+    snapshot.append(["download_connections", [], _connections["in_use"]])
+    return snapshot
+
+def flush_metrics():
+    # Runs in each process that serves requests
+    os.makedirs(METRICS_FOLDER, exist_ok=True)
+    path = os.path.join(METRICS_FOLDER, f"{os.getpid()}.json")
+    while True:
+        tmp = f"{path}.part"
+        with open(tmp, "w") as f:
+            json.dump(metrics_snapshot(), f)
+        os.replace(tmp, path)
+        time.sleep(METRICS_FLUSH_INTERVAL)
+
+def start_metrics_flusher():
+    global _metrics_flusher
+    if _metrics_flusher is None:
+        _metrics_flusher = threading.Thread(target=flush_metrics, name="metrics-flush", daemon=True)
+        _metrics_flusher.start()
+
+def collect_metrics():
+    """This process's live values plus the last snapshot of every other live
+    worker process"""
+    totals = {}
+
+    def add(name, labels, value):
+        key = (name, tuple(tuple(pair) for pair in labels))
+        if isinstance(value, list):
+            current = totals.setdefault(key, [0] * len(value))
+            for i, v in enumerate(value):
+                current[i] += v
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+    for name, labels, value in metrics_snapshot():
+        add(name, labels, value)
+    if os.path.isdir(METRICS_FOLDER):
+        for entry in os.scandir(METRICS_FOLDER):
+            pid = entry.name.split(".")[0]
+            if not entry.name.endswith(".json") or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            if not process_alive(int(pid)):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry.path)
+                continue
+            try:
+                with open(entry.path) as f:
+                    for name, labels, value in json.load(f):
+                        add(name, labels, value)
+            except (OSError, ValueError):
+                continue
+    return totals
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{label_value(v)}"' for k, v in pairs) + "}"
+
+def render_metrics(totals):
+    """Prometheus text exposition format"""
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        full_name = f"mp3server_{name}"
+        lines.append(f"# HELP {full_name} {description}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for (metric, labels), value in sorted(totals.items()):
+            if metric != name:
+                continue
+            if kind != "histogram":
+                lines.append(f"{full_name}{format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, value):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f"{full_name}_bucket{format_labels(labels, le=le)} {cumulative}")
+            lines.append(f"{full_name}_sum{format_labels(labels)} {value[-1]}")
+            lines.append(f"{full_name}_count{format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+def ffmpeg_args():
+    return ["-threads", str(FFMPEG_THREADS)] if FFMPEG_THREADS else []
+
+def niced(command):
+    return ["nice", "-n", str(FFMPEG_NICE), *command] if FFMPEG_NICE else command
+
+_audio_profile = AUDIO_PROFILES[AUDIO_PROFILE]
+
+# Command-line options for the subprocess engine and the equivalent
+# YoutubeDL params for the embedded engine
+YT_DLP_ARGS = {
+    "audio": [
+        "-f", _audio_profile["source"],
+        "--extract-audio",
+        "--audio-format", _audio_profile["codec"],
+        "--audio-quality", _audio_profile["quality"],
+        *(["--postprocessor-args", "ExtractAudio:" + " ".join(ffmpeg_args())] if FFMPEG_THREADS else []),
+    ],
+    "video": [
+        "-f", VIDEO_FORMAT,
+        "--no-write-thumbnail",
+        "--no-write-info-json",
+        "--no-warnings",
+    ],
+}
+
+YT_DLP_PARAMS = {
+    "audio": {
+        "format": _audio_profile["source"],
+        "postprocessors": [{
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": _audio_profile["codec"],
+            "preferredquality": _audio_profile["quality"],
+        }],
+        "postprocessor_args": {"extractaudio": ffmpeg_args()},
+    },
+    "video": {
+        "format": VIDEO_FORMAT,
+        "writethumbnail": False,
+        "writeinfojson": False,
+        "no_warnings": True,
+    },
+}
+
+def parse_number(value):
+    # yt-dlp renders missing template fields as "NA"
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def download_progress(downloaded, total, speed, eta):
+    return {
+        "stage": "downloading",
+        "percent": round(downloaded * 100 / total, 1) if downloaded is not None and total else None,
+        "downloaded": downloaded,
+        "total": total,
+        "speed": speed,
+        "eta": eta,
+    }
+
+def postprocess_progress(postprocessor, status):
+    return {"stage": "postprocessing", "postprocessor": postprocessor, "status": status}
+
+def throttle_progress(on_progress):
+    """Drop events that arrive within PROGRESS_INTERVAL of the last one of the
+    same stage; stage changes always get through"""
+    if on_progress is None:
+        return lambda event: None
+    last = {"time": 0.0, "stage": None, "status": None}
+
+    def report(event):
+        now = time.monotonic()
+        changed = (event["stage"], event.get("status")) != (last["stage"], last["status"])
+        if not changed and now - last["time"] < PROGRESS_INTERVAL:
+            return
+        last.update(time=now, stage=event["stage"], status=event.get("status"))
+        on_progress(event)
+    return report
+
+# Lines yt-dlp is asked to print, tagged so they can be told apart from its
+# ordinary output on the same pipe
+YT_DLP_PROGRESS_ARGS = [
+    "--progress",
+    "--newline",
+    "--progress-template", "download:[progress] download %(progress.downloaded_bytes)s "
+                           "%(progress.total_bytes)s %(progress.total_bytes_estimate)s "
+                           "%(progress.speed)s %(progress.eta)s",
+    "--progress-template", "postprocess:[progress] postprocess %(progress.postprocessor)s "
+                           "%(progress.status)s",
+    "--print", "before_dl:[info] %(.{id,title,duration})j",
+    "--print", "after_move:[filepath] %(filepath)s",
+]
+
+def parse_progress_line(line):
+    fields = line.split()
+    if len(fields) == 7 and fields[1] == "download":
+        downloaded, total, estimate, speed, eta = map(parse_number, fields[2:])
+        total = total or estimate
+        return download_progress(
+            int(downloaded) if downloaded is not None else None,
+            int(total) if total else None,
+            speed, eta)
+    if len(fields) == 4 and fields[1] == "postprocess":
+        return postprocess_progress(fields[2], fields[3])
+    return None
+
+def run_yt_dlp(options, url, folder, on_progress=None):
+    """Run a single yt-dlp pass and return (info, final file path), where info
+    holds the id, title and duration"""
+    # The title and the post-processed file path are printed by the same run
+    # that downloads, so there's no separate --get-title probe
+    # Niceness is inherited by the ffmpeg that yt-dlp runs. The output name
+    # depends only on the video id, so a job resumed after a restart picks
+    # up the .part file (and fragments) its interrupted run left behind.
+    # --no-playlist: a watch?v=X&list=Y URL is keyed (and cached) as X alone
+    command = niced([
+        YT_DLP,
+        *options,
+        "--no-playlist",
+        "--no-simulate",
+        "--continue",
+        *YT_DLP_PROGRESS_ARGS,
+        "-o", os.path.join(folder, "%(id)s.%(ext)s"),
+        url
+    ])
+    report = throttle_progress(on_progress)
+    info = file_path = None
+    # Anything untagged is kept only for the error message
+    output = collections.deque(maxlen=50)
+    with tracked_process("yt-dlp"), \
+            subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             text=True, errors="replace") as proc:
+        for line in proc.stdout:
+            line = line.rstrip("\n")
+            if line.startswith("[progress] "):
+                event = parse_progress_line(line)
+                if event:
+                    report(event)
+            elif line.startswith("[info] "):
+                info = json.loads(line[len("[info] "):])
+            elif line.startswith("[filepath] "):
+                file_path = line[len("[filepath] "):].strip()
+            else:
+                output.append(line)
+    if proc.returncode != 0 or info is None or file_path is None:
+        raise subprocess.CalledProcessError(proc.returncode, command, "\n".join(output))
+    return info, file_path
+
+# One YoutubeDL per (kind, folder) in each embedded worker process, so the
+# extractor classes and their caches stay warm between downloads
+_embedded_ydl = {}
+# Set by the pool initializer: events go back to the server tagged with the
+# token of the download this worker is running
+_embedded_events = None
+_embedded_token = None
+
+def embedded_progress_hook(d):
+    if d["status"] != "downloading":
+        return
+    total = d.get("total_bytes") or d.get("total_bytes_estimate")
+    event = download_progress(d.get("downloaded_bytes"), total, d.get("speed"), d.get("eta"))
+    _embedded_events.put((_embedded_token, event))
+
+def embedded_postprocessor_hook(d):
+    _embedded_events.put((_embedded_token, postprocess_progress(d["postprocessor"], d["status"])))
+
+def embedded_ydl(kind, folder):
+    key = (kind, folder)
+    if key not in _embedded_ydl:
+        import yt_dlp
+        params = dict(YT_DLP_PARAMS[kind])
+        params.update({
+            "outtmpl": os.path.join(folder, "%(id)s.%(ext)s"),
+            "continuedl": True,
+            "noplaylist": True,
+            "quiet": True,
+            "noprogress": True,
+            "progress_hooks": [embedded_progress_hook],
+            "postprocessor_hooks": [embedded_postprocessor_hook],
+        })
+        ydl = yt_dlp.YoutubeDL(params)
+        _embedded_ydl[key] = ydl
+    return _embedded_ydl[key]
+
+def warm_embedded_worker(folders, events):
+    global _embedded_events
+    _embedded_events = events
+    if FFMPEG_NICE:
+        os.nice(FFMPEG_NICE)
+    for kind, folder in folders.items():
+        embedded_ydl(kind, folder)
+
+def embedded_download(kind, url, folder, token, params=None):
+    """Runs in an embedded worker process; returns (info, final file path)"""
+    global _embedded_token
+    _embedded_token = token
+    ydl = embedded_ydl(kind, folder)
+    # Per-download settings (e.g. fragment concurrency) on the cached instance
+    ydl.params.update(params or {})
+    try:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=True))
+    except Exception as e:
+        # yt-dlp exceptions don't always pickle cleanly back to the server
+        raise Exception(str(e))
+    meta = {field: info.get(field) for field in ("id", "title", "duration")}
+    return meta, info["requested_downloads"][-1]["filepath"]
+
+_embedded_pool = None
+_embedded_pool_lock = threading.Lock()
+_embedded_listeners = {}
+
+def relay_embedded_events(events):
+    # Server side: hand worker progress events to the download waiting on them
+    while True:
+        token, event = events.get()
+        report = _embedded_listeners.get(token)
+        if report:
+            report(event)
+
+def get_embedded_pool():
+    global _embedded_pool
+    with _embedded_pool_lock:
+        if _embedded_pool is None:
+            # spawn rather than fork: the server process is multi-threaded
+            context = multiprocessing.get_context("spawn")
+            events = context.Queue()
+            threading.Thread(target=relay_embedded_events, args=(events,),
+                             name="embedded-events", daemon=True).start()
+            _embedded_pool = ProcessPoolExecutor(
+                max_workers=EMBEDDED_WORKERS,
+                mp_context=context,
+                initializer=warm_embedded_worker,
+                initargs=({"audio": DOWNLOAD_FOLDER, "video": VIDEO_DOWNLOAD_FOLDER}, events),
+            )
+        return _embedded_pool
+
+def run_embedded(kind, url, folder, on_progress=None, params=None):
+    global _embedded_pool
+    pool = get_embedded_pool()
+    token = uuid.uuid4().hex
+    _embedded_listeners[token] = throttle_progress(on_progress)
+    try:
+        return pool.submit(embedded_download, kind, url, folder, token, params).result()
+    except BrokenProcessPool:
+        # A worker died mid-download; start a fresh pool for the next job
+        with _embedded_pool_lock:
+            if _embedded_pool is pool:
+                _embedded_pool = None
+        raise Exception("Download worker crashed")
+    finally:
+        del _embedded_listeners[token]
+
+# Connections held by this process's downloads (for metrics). The condition
+# wakes its waiters when it frees some; other processes' releases are
+# noticed by polling.
+_connections = {"in_use": 0}
+_connections_cond = threading.Condition()
+
+def acquire_connections(wanted):
+    """Reserve up to wanted connections (at least one) from MAX_CONNECTIONS.
+
+    Each connection is an flock on one of MAX_CONNECTIONS slot files, so the
+    limit holds across worker processes and a crashed one frees its slots.
+    Returns the slot descriptors to pass to release_connections().
+    """
+    os.makedirs(CONNECTIONS_FOLDER, exist_ok=True)
+    while True:
+        slots = []
+        for i in range(MAX_CONNECTIONS):
+            if len(slots) == wanted:
+                break
+            fd = os.open(os.path.join(CONNECTIONS_FOLDER, f"{i}.lock"),
+                         os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            slots.append(fd)
+        if slots:
+            with _connections_cond:
+                _connections["in_use"] += len(slots)
+            return slots
+        with _connections_cond:
+            _connections_cond.wait(1)
+
+def release_connections(slots):
+    for fd in slots:
+        os.close(fd)
+    with _connections_cond:
+        _connections["in_use"] -= len(slots)
+        _connections_cond.notify_all()
+
+# Per-host fragment concurrency search: keep moving concurrency in the same
+# direction (doubling or halving) while throughput improves, turn back when
+# it doesn't. The best throughput decays so the search never settles on a
+# stale measurement.
+_fragment_tuning = {}
+_fragment_tuning_lock = threading.Lock()
+
+def fragment_concurrency(host):
+    with _fragment_tuning_lock:
+        return _fragment_tuning.get(host, {}).get("n", FRAGMENT_CONCURRENCY)
+
+def record_throughput(host, n, throughput):
+    with _fragment_tuning_lock:
+        tuning = _fragment_tuning.setdefault(host, {"n": n, "best": 0.0, "direction": 2})
+        if throughput > tuning["best"] * 1.1:
+            tuning["best"] = throughput
+        else:
+            tuning["best"] *= 0.9
+            tuning["direction"] = 0.5 if tuning["direction"] > 1 else 2
+        step = n * tuning["direction"]
+        tuning["n"] = int(min(max(step, FRAGMENT_CONCURRENCY_MIN), FRAGMENT_CONCURRENCY_MAX))
+
+def video_options(connections):
+    """(yt-dlp arguments, YoutubeDL params) for a video download"""
+    args = ["-N", str(connections)]
+    params = {"concurrent_fragment_downloads": connections}
+    if VIDEO_DOWNLOADER == "aria2c":
+        aria2c_args = ["-x", str(min(connections, 16)), "-s", str(connections), "-k", "1M"]
+        args += ["--downloader", "aria2c", "--downloader-args", "aria2c:" + " ".join(aria2c_args)]
+        params.update(external_downloader={"default": "aria2c"},
+                      external_downloader_args={"aria2c": aria2c_args})
+    elif VIDEO_DOWNLOADER == "ffmpeg":
+        args += ["--downloader", "ffmpeg"]
+        params["external_downloader"] = {"default": "ffmpeg"}
+    return args, params
+
+def fetch_video(url, folder, on_progress=None):
+    # Tuned per site: every YouTube link spelling shares one setting
+    extractor, _ = canonical_media_id(url)
+    host = extractor if extractor != "generic" else urllib.parse.urlsplit(url).hostname or ""
+    slots = acquire_connections(fragment_concurrency(host))
+    connections = len(slots)
+    args, params = video_options(connections)
+    start = time.perf_counter()
+    # The download phase ends at the first postprocessor event (the merge)
+    downloaded = []
+
+    def report(event):
+        if event["stage"] == "postprocessing" and not downloaded:
+            downloaded.append(time.perf_counter())
+        if on_progress:
+            on_progress(event)
+
+    try:
+        if DOWNLOAD_ENGINE == "embedded":
+            info, file_path = run_embedded("video", url, folder, report, params)
+        else:
+            info, file_path = run_yt_dlp(YT_DLP_ARGS["video"] + args, url, folder, report)
+    finally:
+        release_connections(slots)
+    elapsed = (downloaded[0] if downloaded else time.perf_counter()) - start
+    if elapsed > 0:
+        record_throughput(host, connections, os.path.getsize(file_path) / elapsed)
+    return info, file_path
+
+def fetch_media(kind, url, folder, on_progress=None):
+    """Download with the configured engine; returns (info, final file path)"""
+    if kind == "video":
+        return fetch_video(url, folder, on_progress)
+    if DOWNLOAD_ENGINE == "embedded":
+        return run_embedded(kind, url, folder, on_progress)
+    return run_yt_dlp(YT_DLP_ARGS[kind], url, folder, on_progress)
+
+def expand_playlist_subprocess(url):
+    command = [
+        YT_DLP,
+        "--flat-playlist",
+        "--no-warnings",
+        "--print", "%(webpage_url,url)s",
+        url
+    ]
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # yt-dlp prints NA for entries without any URL
+    lines = (line.strip() for line in result.stdout.decode().splitlines())
+    return [line for line in lines if line and line != "NA"]
+
+def embedded_expand(url):
+    """Runs in an embedded worker process; returns the playlist's entry URLs"""
+    ydl = _embedded_ydl.get("playlist")
+    if ydl is None:
+        import yt_dlp
+        ydl = _embedded_ydl["playlist"] = yt_dlp.YoutubeDL({"extract_flat": "in_playlist", "quiet": True})
+    try:
+        info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        raise Exception(str(e))
+    entries = info.get("entries")
+    if entries is None:
+        return [info.get("webpage_url") or url]
+    # Entries without any URL (deleted or private videos) are skipped
+    urls = (e.get("webpage_url") or e.get("url") for e in entries if e)
+    return [u for u in urls if u]
+
+def expand_playlist(url):
+    """List the entry URLs of a playlist in a single extractor call"""
+    if DOWNLOAD_ENGINE == "embedded":
+        return get_embedded_pool().submit(embedded_expand, url).result()
+    return expand_playlist_subprocess(url)
+
+def store_download(raw_title, file_path, folder):
+    # Move yt-dlp's id-named output to the sanitized title name
+    safe_title = sanitize_filename(raw_title) + os.path.splitext(file_path)[1]
+    os.replace(file_path, os.path.join(folder, safe_title))
+    return safe_title
+
+YOUTUBE_HOSTS = {
+    "youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com",
+    "youtube-nocookie.com", "www.youtube-nocookie.com",
+}
+YOUTUBE_ID = re.compile(r"^[0-9A-Za-z_-]{11}$")
+
+def canonical_media_id(url):
+    """Map a URL to (extractor, video id), ignoring how the link was written"""
+    parsed = urllib.parse.urlsplit(url.strip())
+    host = (parsed.hostname or "").lower()
+    parts = [p for p in parsed.path.split("/") if p]
+    video_id = None
+    if host in ("youtu.be", "www.youtu.be") and parts:
+        video_id = parts[0]
+    elif host in YOUTUBE_HOSTS:
+        if parts[:1] == ["watch"]:
+            video_id = urllib.parse.parse_qs(parsed.query).get("v", [None])[0]
+        elif len(parts) >= 2 and parts[0] in ("embed", "shorts", "live", "v"):
+            video_id = parts[1]
+    if video_id and YOUTUBE_ID.match(video_id):
+        return "youtube", video_id
+
+    # Anything else is keyed by the normalized URL itself
+    normalized = urllib.parse.urlunsplit((
+        parsed.scheme.lower(), parsed.netloc.lower(), parsed.path, parsed.query, ""))
+    return "generic", normalized
+
+def media_key(url, fmt):
+    extractor, video_id = canonical_media_id(url)
+    return f"{extractor}:{video_id}:{fmt}"
+
+_media_cache_lock = threading.Lock()
+_media_cache_db = None
+
+def media_cache():
+    # Called with _media_cache_lock held
+    global _media_cache_db
+    if _media_cache_db is None:
+        _media_cache_db = sqlite3.connect(MEDIA_CACHE_DB, check_same_thread=False)
+        _media_cache_db.execute("PRAGMA journal_mode=WAL")
+        _media_cache_db.execute("""
+            CREATE TABLE IF NOT EXISTS media (
+                key TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        _media_cache_db.execute("CREATE INDEX IF NOT EXISTS media_last_used ON media (last_used)")
+        _media_cache_db.execute("""
+            CREATE TABLE IF NOT EXISTS info (
+                id TEXT PRIMARY KEY,
+                info TEXT NOT NULL,
+                fetched REAL NOT NULL
+            )""")
+        _media_cache_db.execute("CREATE INDEX IF NOT EXISTS info_fetched ON info (fetched)")
+    return _media_cache_db
+
+def cache_lookup(key):
+    """Return the cached filename for key, or None if missing or stale"""
+    with _media_cache_lock:
+        db = media_cache()
+        row = db.execute("SELECT folder, filename, size FROM media WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        folder, filename, size = row
+        try:
+            fresh = os.stat(os.path.join(folder, filename)).st_size == size
+        except OSError:
+            fresh = False
+        with db:
+            if not fresh:
+                # Deleted or replaced by hand since it was indexed
+                db.execute("DELETE FROM media WHERE key = ?", (key,))
+                return None
+            db.execute("UPDATE media SET last_used = ? WHERE key = ?", (time.time(), key))
+        return filename
+
+def cache_store(key, folder, filename):
+    now = time.time()
+    size = os.path.getsize(os.path.join(folder, filename))
+    with _media_cache_lock:
+        db = media_cache()
+        with db:
+            # A new download under the same name supersedes older keys for it
+            db.execute("DELETE FROM media WHERE folder = ? AND filename = ?", (folder, filename))
+            db.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, folder, filename, size, now, now))
+        evict_media_cache(db, keep=key)
+
+def remove_media(db, key, folder, filename):
+    """Delete an indexed file and its row. Called with _media_cache_lock held;
+    returns False if the file is in use or couldn't be removed."""
+    path = os.path.join(folder, filename)
+    if is_pinned(path):
+        return False
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning("Could not evict %s: %s", filename, e)
+        return False
+    db.execute("DELETE FROM media WHERE key = ?", (key,))
+    return True
+
+def evict_media_cache(db, keep=None):
+    # Called with _media_cache_lock held
+    if MEDIA_CACHE_MAX_BYTES <= 0:
+        return
+    total = db.execute("SELECT COALESCE(SUM(size), 0) FROM media").fetchone()[0]
+    if total <= MEDIA_CACHE_MAX_BYTES:
+        return
+    rows = db.execute("SELECT key, folder, filename, size FROM media ORDER BY last_used").fetchall()
+    with db:
+        for key, folder, filename, size in rows:
+            if total <= MEDIA_CACHE_MAX_BYTES:
+                break
+            if key != keep and remove_media(db, key, folder, filename):
+                total -= size
+
+def touch_media(folder, filename):
+    """Record that an indexed file was just served"""
+    with _media_cache_lock:
+        db = media_cache()
+        with db:
+            db.execute("UPDATE media SET last_used = ? WHERE folder = ? AND filename = ?",
+                       (time.time(), folder, filename))
+
+# Paths currently being served or imported, with a count per path
+_pins = collections.Counter()
+_pins_lock = threading.Lock()
+
+def pin(path):
+    with _pins_lock:
+        _pins[path] += 1
+
+def unpin(path):
+    with _pins_lock:
+        _pins[path] -= 1
+        if _pins[path] <= 0:
+            del _pins[path]
+
+def is_pinned(path):
+    with _pins_lock:
+        return path in _pins
+
+@contextlib.contextmanager
+def pinned(path):
+    pin(path)
+    try:
+        yield
+    finally:
+        unpin(path)
+
+def janitor_pass():
+    """Apply FOLDER_QUOTAS, evicting least recently served files first"""
+    now = time.time()
+    with _media_cache_lock:
+        db = media_cache()
+        rows = db.execute(
+            "SELECT key, folder, filename, size, created, last_used FROM media ORDER BY last_used").fetchall()
+        by_folder = collections.defaultdict(list)
+        for row in rows:
+            by_folder[row[1]].append(row)
+
+        evicted = 0
+        with db:
+            for folder, entries in by_folder.items():
+                quota = FOLDER_QUOTAS.get(folder)
+                if not quota:
+                    continue
+                total = sum(e[3] for e in entries)
+                count = len(entries)
+                max_age = quota["max_age_days"] * 86400
+                for key, _, filename, size, created, last_used in entries:
+                    if not os.path.exists(os.path.join(folder, filename)):
+                        # Deleted by hand; just forget it
+                        db.execute("DELETE FROM media WHERE key = ?", (key,))
+                        total -= size
+                        count -= 1
+                        continue
+                    over = ((quota["max_bytes"] and total > quota["max_bytes"])
+                            or (quota["max_files"] and count > quota["max_files"]))
+                    expired = max_age and now - created > max_age
+                    if not (over or expired) or now - last_used < JANITOR_GRACE:
+                        continue
+                    if remove_media(db, key, folder, filename):
+                        total -= size
+                        count -= 1
+                        evicted += 1
+    if evicted:
+        log.info("Janitor evicted %d files", evicted)
+
+def janitor():
+    lock_path = os.path.join(STATE_FOLDER, "janitor.lock")
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        # With several worker processes only one of them sweeps at a time
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            try:
+                janitor_pass()
+                compact_job_store()
+            except Exception:
+                log.exception("Janitor pass failed")
+
+_janitor_started = False
+
+def start_janitor():
+    global _janitor_started
+    if not _janitor_started:
+        _janitor_started = True
+        threading.Thread(target=janitor, name="janitor", daemon=True).start()
+
+def disk_has_room(folder):
+    if shutil.disk_usage(folder).free >= DISK_MIN_FREE_BYTES:
+        return True
+    # Low on space: sweep now rather than waiting for the next pass
+    janitor_pass()
+    return shutil.disk_usage(folder).free >= DISK_MIN_FREE_BYTES
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def single_flight(key, fn):
+    """Run fn once per key at a time; concurrent callers share its result"""
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = {"done": threading.Event(), "result": None, "error": None}
+            _inflight[key] = call
+
+    if not leader:
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+    try:
+        call["result"] = fn()
+        return call["result"]
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        call["done"].set()
+
+def download_media(kind, url, folder, fmt, failure, on_progress=None):
+    key = media_key(url, fmt)
+
+    def run():
+        with timed("cache_lookup", kind):
+            cached = cache_lookup(key)
+        inc("cache_requests_total", cache="media", result="hit" if cached else "miss")
+        if cached:
+            return cached
+
+        # The postprocess stage is split out of the yt-dlp run by the time
+        # of its first postprocessor event
+        postprocess_started = []
+
+        def report(event):
+            if event["stage"] == "postprocessing" and not postprocess_started:
+                postprocess_started.append(time.perf_counter())
+            if on_progress:
+                on_progress(event)
+
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            info, file_path = fetch_media(kind, url, folder, report)
+            outcome = "ok"
+        except subprocess.CalledProcessError as e:
+            log.warning("yt-dlp failed for %s", url, extra={"output": e.output})
+            raise Exception(failure)
+        except Exception:
+            raise Exception(failure)
+        finally:
+            end = time.perf_counter()
+            fetched = postprocess_started[0] if postprocess_started else end
+            observe("stage_seconds", fetched - start, stage="fetch", kind=kind, outcome=outcome)
+            if postprocess_started:
+                observe("stage_seconds", end - fetched, stage="postprocess", kind=kind, outcome=outcome)
+
+        with timed("store", kind):
+            filename = store_download(info["title"], file_path, folder)
+            cache_store(key, folder, filename)
+        index_download(folder, filename, info)
+        return filename
+
+    return single_flight(key, run)
+
+def download_audio(url, on_progress=None):
+    log.info("Downloading %s", url)
+    return download_media("audio", url, DOWNLOAD_FOLDER, AUDIO_PROFILE, "Download failed", on_progress)
+
+def download_mp4(url, on_progress=None):
+    return download_media("video", url, VIDEO_DOWNLOAD_FOLDER, "mp4", "MP4 download failed", on_progress)
+
+# Fields of yt-dlp's info dict kept in the info cache
+INFO_FIELDS = ("id", "title", "duration", "uploader", "channel", "upload_date", "extractor",
+               "webpage_url", "thumbnail", "thumbnails")
+FORMAT_FIELDS = ("format_id", "ext", "acodec", "vcodec", "abr", "vbr", "tbr", "width", "height",
+                 "fps", "filesize", "filesize_approx", "format_note")
+
+def trim_info(info):
+    trimmed = {field: info.get(field) for field in INFO_FIELDS}
+    trimmed["formats"] = [{field: f.get(field) for field in FORMAT_FIELDS}
+                          for f in info.get("formats") or ()]
+    return trimmed
+
+def extract_info_subprocess(url):
+    command = [YT_DLP, "-J", "--no-playlist", "--no-warnings", url]
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return trim_info(json.loads(result.stdout))
+
+def embedded_info(url):
+    """Runs in an embedded worker process; returns the trimmed info dict"""
+    ydl = _embedded_ydl.get("info")
+    if ydl is None:
+        import yt_dlp
+        ydl = _embedded_ydl["info"] = yt_dlp.YoutubeDL({"noplaylist": True, "quiet": True})
+    try:
+        return trim_info(ydl.sanitize_info(ydl.extract_info(url, download=False)))
+    except Exception as e:
+        raise Exception(str(e))
+
+_info_cache = collections.OrderedDict()
+_info_lock = threading.Lock()
+
+def remember_info(media_id, entry):
+    with _info_lock:
+        _info_cache[media_id] = entry
+        _info_cache.move_to_end(media_id)
+        while len(_info_cache) > INFO_CACHE_SIZE:
+            _info_cache.popitem(last=False)
+
+def cached_info(media_id):
+    """Return (info, fetched) from memory or the database, or None if expired"""
+    now = time.time()
+    with _info_lock:
+        entry = _info_cache.get(media_id)
+        if entry:
+            _info_cache.move_to_end(media_id)
+    if entry is None:
+        with _media_cache_lock:
+            row = media_cache().execute(
+                "SELECT info, fetched FROM info WHERE id = ?", (media_id,)).fetchone()
+        if row is None:
+            return None
+        entry = (json.loads(row[0]), row[1])
+        remember_info(media_id, entry)
+    if now - entry[1] > INFO_CACHE_TTL:
+        return None
+    return entry
+
+def store_info(media_id, info):
+    entry = (info, time.time())
+    remember_info(media_id, entry)
+    with _media_cache_lock:
+        db = media_cache()
+        with db:
+            db.execute("INSERT OR REPLACE INTO info VALUES (?, ?, ?)",
+                       (media_id, json.dumps(info), entry[1]))
+            db.execute("DELETE FROM info WHERE fetched < ?", (entry[1] - INFO_CACHE_TTL,))
+            db.execute("""
+                DELETE FROM info WHERE id NOT IN (
+                    SELECT id FROM info ORDER BY fetched DESC LIMIT ?)""", (INFO_CACHE_MAX_ROWS,))
+    return entry
+
+def invalidate_info(media_id):
+    with _info_lock:
+        _info_cache.pop(media_id, None)
+    with _media_cache_lock:
+        db = media_cache()
+        with db:
+            db.execute("DELETE FROM info WHERE id = ?", (media_id,))
+
+def get_info(url, refresh=False):
+    """Return (info, fetched, hit) for url, running the extractor on a miss"""
+    media_id = ":".join(canonical_media_id(url))
+    entry = None if refresh else cached_info(media_id)
+    inc("cache_requests_total", cache="info", result="hit" if entry else "miss")
+    if entry:
+        return entry[0], entry[1], True
+
+    def run():
+        with timed("extract", "info"):
+            if DOWNLOAD_ENGINE == "embedded":
+                info = get_embedded_pool().submit(embedded_info, url).result()
+            else:
+                info = extract_info_subprocess(url)
+        return store_info(media_id, info)
+
+    info, fetched = single_flight("info:" + media_id, run)
+    return info, fetched, False
+
+
+_screenshots_root = None
+_screenshots_root_lock = threading.Lock()
+
+def screenshots_root():
+    """(real path, directory fd) of SCREENSHOTS_FOLDER, resolved once"""
+    global _screenshots_root
+    with _screenshots_root_lock:
+        if _screenshots_root is None:
+            real = os.path.realpath(SCREENSHOTS_FOLDER)
+            fd = os.open(real, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+            _screenshots_root = (real, fd)
+        return _screenshots_root
+
+def within(root, path):
+    return os.path.commonpath([root, path]) == root
+
+def fd_path(fd):
+    """Where an open descriptor really is, or None if the OS won't say"""
+    try:
+        if hasattr(fcntl, "F_GETPATH"):  # macOS
+            return os.fsdecode(fcntl.fcntl(fd, fcntl.F_GETPATH, bytes(1024)).rstrip(b"\0"))
+        return os.readlink(f"/proc/self/fd/{fd}")
+    except OSError:
+        return None
+
+def open_screenshot(rel_path):
+    """Open a path under the screenshots folder: (real path, stat, fd).
+
+    One openat() relative to the cached root with O_NOFOLLOW, an fstat() and
+    a lookup of where the descriptor landed replace realpath()'s walk over
+    every component. Raises PermissionError for anything outside the folder
+    (including a symlink as the last component) and FileNotFoundError.
+    The caller owns fd; reading through it serves exactly what was checked,
+    even if the path is swapped for a symlink afterwards.
+    """
+    rel_path = os.path.normpath(rel_path.lstrip("/") or ".")
+    if rel_path == ".." or rel_path.startswith("../"):
+        raise PermissionError(rel_path)
+    root, root_fd = screenshots_root()
+    try:
+        fd = os.open(rel_path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK | os.O_CLOEXEC, dir_fd=root_fd)
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            raise PermissionError(rel_path)
+        raise
+    try:
+        st = os.fstat(fd)
+        # Intermediate symlinks are still followed; make sure they didn't lead out
+        real = fd_path(fd) or os.path.realpath(os.path.join(root, rel_path))
+        if not within(root, real):
+            raise PermissionError(rel_path)
+    except BaseException:
+        os.close(fd)
+        raise
+    return real, st, fd
+
+def resolve_screenshot(rel_path):
+    """open_screenshot() for callers that only need (real path, stat)"""
+    real, st, fd = open_screenshot(rel_path)
+    os.close(fd)
+    return real, st
+
+# Errors meaning "not possible between these two paths", as opposed to real
+# failures like a missing file or a permissions problem
+IMPORT_FALLBACK_ERRORS = {
+    errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP,
+    errno.EINVAL, errno.ENOSYS, errno.EMLINK,
+}
+
+_libc = None
+
+def clonefile(src, dest):
+    """macOS clonefile(2): dest shares src's data blocks until either changes"""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    if _libc.clonefile(os.fsencode(src), os.fsencode(dest), 0) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), src)
+
+def reflink_file(src, dest):
+    if sys.platform == "darwin":
+        # shutil.copyfile() uses fcopyfile(COPYFILE_DATA), a full byte copy;
+        # only clonefile() clones on APFS
+        try:
+            clonefile(src, dest)
+        except OSError as e:
+            # Not APFS, or src and dest on different volumes
+            if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV):
+                raise
+            shutil.copyfile(src, dest)
+        return
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(src, dest)
+        return
+    # Linux: the kernel shares extents (reflink) where the filesystem can,
+    # otherwise it copies in-kernel without bouncing through user space
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+def copy_into(src, dest, copy=shutil.copyfile):
+    # Copy under a hidden name and rename, so the importer never sees a
+    # half-written file
+    tmp = os.path.join(os.path.dirname(dest), f".{uuid.uuid4().hex}.part")
+    try:
+        copy(src, tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+IMPORT_STRATEGIES = {
+    "hardlink": os.link,
+    "reflink": lambda src, dest: copy_into(src, dest, reflink_file),
+    "rename": os.replace,
+    "copy": copy_into,
+}
+
+def import_to_music(file_path):
+    """Place a finished audio file in Apple Music's auto-import folder"""
+    dest = os.path.join(MUSIC_IMPORT_FOLDER, os.path.basename(file_path))
+    strategy = IMPORT_STRATEGIES.get(MUSIC_IMPORT_STRATEGY, copy_into)
+    try:
+        strategy(file_path, dest)
+    except FileExistsError:
+        # Still waiting to be picked up from an earlier import
+        pass
+    except OSError as e:
+        if e.errno not in IMPORT_FALLBACK_ERRORS:
+            raise
+        copy_into(file_path, dest)
+
+def job_progress(job):
+    return lambda event: update_job(job, progress=event)
+
+def run_audio_job(job):
+    filename = download_audio(job["url"], job_progress(job))
+    if not _audio_profile["music"]:
+        return {"file": filename, "status": f"saved to the server (Apple Music can't import {_audio_profile['codec']})"}
+    update_job(job, progress={"stage": "importing"})
+    file_path = os.path.join(DOWNLOAD_FOLDER, filename)
+    with timed("import", "audio"), pinned(file_path):
+        import_to_music(file_path)
+    return {"file": filename, "status": "imported to Apple Music"}
+
+def run_video_job(job):
+    filename = download_mp4(job["url"], job_progress(job))
+    return {"file": filename, "saved_to": VIDEO_DOWNLOAD_FOLDER}
+
+JOB_KINDS = {
+    "audio": {"run": run_audio_job, "workers": AUDIO_WORKERS, "format": AUDIO_PROFILE, "folder": DOWNLOAD_FOLDER},
+    "video": {"run": run_video_job, "workers": VIDEO_WORKERS, "format": "mp4", "folder": VIDEO_DOWNLOAD_FOLDER},
+}
+
+def client_weight(client):
+    return API_KEYS.get(client.partition(":")[2], 1) if client.startswith("key:") else 1
+
+class FairQueue:
+    """Job queue shared fairly between clients (start-time fair queuing).
+
+    Each job is tagged with a virtual start time: the later of the queue's
+    current virtual time and the end of its client's previous job, where a
+    job "lasts" 1/weight. Jobs run in tag order, so a client that queued
+    many jobs can't hold back one that queued a single job.
+    """
+
+    def __init__(self, maxsize, per_client):
+        self.maxsize = maxsize
+        self.per_client = per_client
+        self.heap = []
+        self.order = itertools.count()
+        self.vtime = 0.0
+        # Per-client end of the last queued job, and jobs waiting
+        self.finish = {}
+        self.queued = collections.Counter()
+        self.cond = threading.Condition(threading.RLock())
+
+    def put_nowait(self, job):
+        with self.cond:
+            client = job.get("client") or ""
+            if len(self.heap) >= self.maxsize or (
+                    self.per_client and self.queued[client] >= self.per_client):
+                raise queue.Full
+            self.put(job)
+
+    def put(self, job):
+        """Queue job regardless of the size limits"""
+        client = job.get("client") or ""
+        with self.cond:
+            start = max(self.vtime, self.finish.get(client, 0.0))
+            self.finish[client] = start + 1 / client_weight(client)
+            self.queued[client] += 1
+            heapq.heappush(self.heap, (start, next(self.order), job))
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while not self.heap:
+                self.cond.wait()
+            start, _, job = heapq.heappop(self.heap)
+            self.vtime = start
+            client = job.get("client") or ""
+            self.queued[client] -= 1
+            if not self.queued[client]:
+                # Nothing left waiting: it rejoins at the current virtual time
+                del self.queued[client]
+                del self.finish[client]
+            return job
+
+    def qsize(self):
+        with self.cond:
+            return len(self.heap)
+
+JOBS = {}
+# Queued or running jobs by media key, so duplicate submissions attach to them
+ACTIVE_JOBS = {}
+JOBS_LOCK = threading.Lock()
+JOB_QUEUES = {}
+# Per-job sets of SSE listener queues
+JOB_SUBSCRIBERS = {}
+
+_jobs_db = None
+_jobs_db_lock = threading.Lock()
+JOB_FIELDS = ("id", "kind", "key", "url", "state", "progress", "result", "error", "created", "updated",
+              "owner", "instance")
+
+def jobs_db():
+    # Called with _jobs_db_lock held; opened lazily so each worker process
+    # (including ones forked from a preloading master) gets its own handle
+    global _jobs_db
+    if _jobs_db is None:
+        _jobs_db = sqlite3.connect(JOBS_DB, check_same_thread=False, timeout=5)
+        _jobs_db.execute("PRAGMA journal_mode=WAL")
+        _jobs_db.execute("PRAGMA synchronous=NORMAL")
+        _jobs_db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                url TEXT NOT NULL,
+                state TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                owner INTEGER NOT NULL,
+                instance TEXT
+            )""")
+        columns = [row[1] for row in _jobs_db.execute("PRAGMA table_info(jobs)")]
+        if "instance" not in columns:
+            # Stores from before instance tokens; their jobs all read as orphaned
+            _jobs_db.execute("ALTER TABLE jobs ADD COLUMN instance TEXT")
+        _jobs_db.execute("CREATE INDEX IF NOT EXISTS jobs_key_state ON jobs (key, state)")
+        _jobs_db.execute("CREATE INDEX IF NOT EXISTS jobs_state_updated ON jobs (state, updated)")
+        _jobs_db.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                urls TEXT NOT NULL,
+                results TEXT NOT NULL
+            )""")
+    return _jobs_db
+
+def job_row(job):
+    row = [job.get(field) for field in JOB_FIELDS]
+    for i in (JOB_FIELDS.index("progress"), JOB_FIELDS.index("result")):
+        row[i] = json.dumps(row[i])
+    return row
+
+def save_job(job):
+    with JOBS_LOCK:
+        row = job_row(job)
+    with _jobs_db_lock:
+        db = jobs_db()
+        with db:
+            db.execute(f"INSERT OR REPLACE INTO jobs VALUES ({', '.join('?' * len(JOB_FIELDS))})", row)
+
+def row_to_job(row):
+    job = dict(zip(JOB_FIELDS, row))
+    job["progress"] = json.loads(job["progress"])
+    job["result"] = json.loads(job["result"])
+    return job
+
+def load_job(job_id):
+    with _jobs_db_lock:
+        row = jobs_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return row_to_job(row) if row else None
+
+def get_job(job_id):
+    """A job from this process, or a snapshot of one owned by another worker"""
+    return JOBS.get(job_id) or load_job(job_id)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+_instance = None
+_instance_lock = threading.Lock()
+
+def process_instance():
+    """A token for this process that, unlike its PID, is never reused.
+
+    The process keeps an exclusive lock on instances/<token>.lock until it
+    exits, which is how other processes tell whether it's still alive.
+    """
+    global _instance
+    with _instance_lock:
+        # A worker forked from a preloading master needs a token of its own
+        if _instance is None or _instance[0] != os.getpid():
+            token = uuid.uuid4().hex
+            os.makedirs(INSTANCES_FOLDER, exist_ok=True)
+            fd = os.open(os.path.join(INSTANCES_FOLDER, f"{token}.lock"),
+                         os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            _instance = (os.getpid(), token, fd)
+        return _instance[1]
+
+def instance_alive(token):
+    if not token:
+        return False
+    path = os.path.join(INSTANCES_FOLDER, f"{token}.lock")
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    else:
+        # Nobody holds it, so its process has exited
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        return False
+    finally:
+        os.close(fd)
+
+def find_active_job(key, db=None):
+    """A queued or running job for key owned by another live worker process.
+
+    Pass db to look inside a transaction the caller holds (with
+    _jobs_db_lock held).
+    """
+    query = ("SELECT * FROM jobs WHERE key = ? AND state IN ('queued', 'running') "
+             "AND instance IS NOT ?", (key, process_instance()))
+    if db is None:
+        with _jobs_db_lock:
+            rows = jobs_db().execute(*query).fetchall()
+    else:
+        rows = db.execute(*query).fetchall()
+    for row in rows:
+        job = row_to_job(row)
+        if instance_alive(job["instance"]):
+            return job
+    return None
+
+def compact_job_store():
+    """Drop finished jobs past JOB_RETENTION or JOB_HISTORY_LIMIT and shrink the WAL"""
+    with _jobs_db_lock:
+        db = jobs_db()
+        with db:
+            db.execute("DELETE FROM jobs WHERE state IN ('done', 'error') AND updated < ?",
+                       (time.time() - JOB_RETENTION,))
+            db.execute("""
+                DELETE FROM jobs WHERE state IN ('done', 'error') AND id NOT IN (
+                    SELECT id FROM jobs WHERE state IN ('done', 'error')
+                    ORDER BY updated DESC LIMIT ?)""", (JOB_HISTORY_LIMIT,))
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def claim_orphaned_jobs():
+    """Take over unfinished jobs whose owning process has died.
+
+    Each job is claimed with a compare-and-set on its owner, so when several
+    worker processes start together every job is claimed by exactly one.
+    """
+    instance = process_instance()
+    with _jobs_db_lock:
+        rows = jobs_db().execute(
+            "SELECT * FROM jobs WHERE state IN ('queued', 'running') AND instance IS NOT ?",
+            (instance,)).fetchall()
+    claimed = []
+    for row in rows:
+        job = row_to_job(row)
+        if instance_alive(job["instance"]):
+            continue
+        progress = {"stage": "queued", "resumed": True}
+        with _jobs_db_lock:
+            db = jobs_db()
+            with db:
+                cursor = db.execute(
+                    "UPDATE jobs SET owner = ?, instance = ?, state = 'queued', progress = ?, "
+                    "updated = ? WHERE id = ? AND instance IS ?",
+                    (os.getpid(), instance, json.dumps(progress), time.time(), job["id"],
+                     job["instance"]))
+        if cursor.rowcount == 1:
+            job.update(owner=os.getpid(), instance=instance, state="queued", progress=progress,
+                       client=None)
+            claimed.append(job)
+    return claimed
+
+_jobs_resumed = False
+
+def resume_jobs():
+    """Re-queue downloads interrupted by a restart or crash (once per process)"""
+    global _jobs_resumed
+    if _jobs_resumed:
+        return
+    _jobs_resumed = True
+    jobs = [job for job in claim_orphaned_jobs() if job["kind"] in JOB_KINDS]
+    if not jobs:
+        return
+    with JOBS_LOCK:
+        start_job_workers()
+        for job in jobs:
+            JOBS[job["id"]] = job
+            ACTIVE_JOBS.setdefault(job["key"], job)
+            # Already admitted once, so not subject to the queue limits
+            JOB_QUEUES[job["kind"]].put(job)
+    log.info("Resumed %d interrupted jobs", len(jobs))
+
+def update_job(job, **fields):
+    with JOBS_LOCK:
+        job.update(fields)
+        job["updated"] = time.time()
+        subscribers = list(JOB_SUBSCRIBERS.get(job["id"], ()))
+    save_job(job)
+    if subscribers:
+        view = job_view(job)
+        for listener in subscribers:
+            try:
+                listener.put_nowait(view)
+            except queue.Full:
+                # A slow client only misses intermediate progress; it
+                # resyncs from the job itself on the next timeout
+                pass
+
+def job_view(job):
+    """Public snapshot of a job for the /jobs endpoint"""
+    with JOBS_LOCK:
+        view = dict(job)
+    view.pop("owner", None)
+    view.pop("instance", None)
+    view.pop("client", None)
+    view["progress"] = dict(view["progress"])
+    view["created"] = datetime.fromtimestamp(view["created"]).isoformat()
+    view["updated"] = datetime.fromtimestamp(view["updated"]).isoformat()
+    return view
+
+def prune_jobs():
+    # Called with JOBS_LOCK held; forget the oldest finished jobs
+    finished = [j for j in JOBS.values() if j["state"] in ("done", "error")]
+    excess = len(JOBS) - JOB_HISTORY_LIMIT
+    for job in sorted(finished, key=lambda j: j["updated"])[:max(excess, 0)]:
+        del JOBS[job["id"]]
+
+def job_worker(kind):
+    jobs = JOB_QUEUES[kind]
+    run = JOB_KINDS[kind]["run"]
+    while True:
+        job = jobs.get()
+        LOG_CONTEXT.job_id = job["id"]
+        observe("job_queue_wait_seconds", time.time() - job["created"], kind=kind)
+        update_job(job, state="running", progress={"stage": "starting"})
+        outcome = "error"
+        try:
+            if not disk_has_room(JOB_KINDS[kind]["folder"]):
+                raise Exception("Not enough free disk space")
+            with timed("job", kind):
+                result = run(job)
+            update_job(job, state="done", progress={"stage": "finished"}, result=result)
+            outcome = "done"
+        except Exception as e:
+            log.warning("Job failed: %s", e)
+            update_job(job, state="error", progress={"stage": "failed"}, error=str(e))
+        finally:
+            inc("jobs_total", kind=kind, outcome=outcome)
+            LOG_CONTEXT.job_id = None
+            with JOBS_LOCK:
+                ACTIVE_JOBS.pop(job["key"], None)
+
+def start_job_workers():
+    # Called with JOBS_LOCK held on the first submission, so importing this
+    # module (e.g. in an embedded engine worker) doesn't start any threads
+    if JOB_QUEUES:
+        return
+    ensure_logging()
+    start_janitor()
+    for kind, spec in JOB_KINDS.items():
+        JOB_QUEUES[kind] = FairQueue(JOB_QUEUE_SIZE, CLIENT_QUEUE_SIZE)
+        for i in range(spec["workers"]):
+            threading.Thread(target=job_worker, args=(kind,),
+                             name=f"{kind}-worker-{i}", daemon=True).start()
+
+_submit_lock = threading.Lock()
+
+def submit_job(kind, url, client=None):
+    """Queue a download job for client. Returns None when the queue (or the
+    client's share of it) is full.
+
+    A submission for media that's already queued or downloading returns the
+    existing job instead of starting another one.
+    """
+    key = media_key(url, JOB_KINDS[kind]["format"])
+    with JOBS_LOCK:
+        if key in ACTIVE_JOBS:
+            return ACTIVE_JOBS[key]
+
+    now = time.time()
+    job_id = uuid.uuid4().hex
+    job = {
+        "id": job_id,
+        "kind": kind,
+        "key": key,
+        "url": url,
+        "state": "queued",
+        "progress": {"stage": "queued"},
+        "result": None,
+        "error": None,
+        "created": now,
+        "updated": now,
+        "owner": os.getpid(),
+        "instance": process_instance(),
+        "client": client,
+    }
+    # Checking for another process's job and recording this one happen in
+    # one write transaction, so two workers can't both start the same media;
+    # _submit_lock does the same between this process's threads
+    with _submit_lock:
+        with JOBS_LOCK:
+            if key in ACTIVE_JOBS:
+                return ACTIVE_JOBS[key]
+        with _jobs_db_lock:
+            db = jobs_db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                remote = find_active_job(key, db)
+                if remote is None:
+                    db.execute(f"INSERT INTO jobs VALUES ({', '.join('?' * len(JOB_FIELDS))})", job_row(job))
+        if remote is not None:
+            return remote
+        with JOBS_LOCK:
+            start_job_workers()
+            try:
+                JOB_QUEUES[kind].put_nowait(job)
+            except queue.Full:
+                job = None
+            else:
+                JOBS[job["id"]] = job
+                ACTIVE_JOBS[key] = job
+                prune_jobs()
+        if job is None:
+            with _jobs_db_lock:
+                db = jobs_db()
+                with db:
+                    db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+    return job
+
+@app.before_request
+def start_request_timer():
+    ensure_logging()
+    start_metrics_flusher()
+    start_janitor()
+    resume_jobs()
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    request.environ["mp3server.start"] = time.perf_counter()
+
+# Rate limit budget for each route; routes not listed aren't limited.
+# /thumb isn't: one /files page lazy-loads up to LISTING_PAGE_SIZE of them,
+# and generating them is already bounded by the THUMB_WORKERS pool.
+ROUTE_BUDGETS = {
+    "/download": "expensive",
+    "/download-mp4": "expensive",
+    "/download/batch": "expensive",
+    "/stream/mp3": "expensive",
+    "/info": "expensive",
+    "/jobs/<job_id>": "cheap",
+    "/jobs/<job_id>/events": "cheap",
+    "/files/": "cheap",
+    "/files/<path:directory>": "cheap",
+    "/file/<filename>": "cheap",
+    "/download-file/<path:file_path>": "cheap",
+    "/download-zip/": "expensive",
+    "/download-zip/<path:directory>": "expensive",
+    "/search": "cheap",
+}
+
+def client_id():
+    """The API key a request was made with if it's a known one, else its address"""
+    api_key = request.headers.get("X-API-Key")
+    if api_key in API_KEYS:
+        return f"key:{api_key}"
+    return f"ip:{request.remote_addr}"
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+_bucket_db = None
+_bucket_db_pruned = 0.0
+
+def refill(tokens, updated, now, rate, burst):
+    """Take one token from a bucket; returns (tokens left, seconds to wait)"""
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+def take_token_memory(bucket, rate, burst, now):
+    with _buckets_lock:
+        tokens, updated = _buckets.get(bucket, (burst, now))
+        tokens, wait = refill(tokens, updated, now, rate, burst)
+        _buckets[bucket] = (tokens, now)
+        if len(_buckets) > 10000:
+            # Forget buckets that have refilled completely
+            for key, (t, u) in list(_buckets.items()):
+                if t + (now - u) * RATE_LIMITS[key[1]][0] >= RATE_LIMITS[key[1]][1]:
+                    del _buckets[key]
+    return wait
+
+def take_token_sqlite(bucket, rate, burst, now):
+    global _bucket_db, _bucket_db_pruned
+    with _buckets_lock:
+        if _bucket_db is None:
+            _bucket_db = sqlite3.connect(RATE_LIMIT_DB, check_same_thread=False,
+                                         timeout=5, isolation_level=None)
+            _bucket_db.execute("PRAGMA journal_mode=WAL")
+            _bucket_db.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    client TEXT NOT NULL,
+                    budget TEXT NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (client, budget)
+                )""")
+        db = _bucket_db
+        # IMMEDIATE takes the write lock up front, so two processes can't
+        # both spend the same token
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT tokens, updated FROM buckets WHERE client = ? AND budget = ?",
+                             bucket).fetchone()
+            tokens, updated = row or (burst, now)
+            tokens, wait = refill(tokens, updated, now, rate, burst)
+            db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)", (*bucket, tokens, now))
+            if now - _bucket_db_pruned > 60:
+                _bucket_db_pruned = now
+                db.execute("DELETE FROM buckets WHERE updated < ?", (now - 3600,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    return wait
+
+@app.before_request
+def rate_limit():
+    budget = ROUTE_BUDGETS.get(request.url_rule.rule if request.url_rule else None)
+    if budget is None:
+        return None
+    rate, burst = RATE_LIMITS[budget]
+    if rate <= 0:
+        return None
+    take_token = take_token_sqlite if RATE_LIMIT_STORE == "sqlite" else take_token_memory
+    wait = take_token((client_id(), budget), rate, burst, time.time())
+    if not wait:
+        return None
+    inc("rate_limited_total", budget=budget)
+    response = jsonify({"error": "Too many requests, slow down"})
+    response.headers["Retry-After"] = str(int(wait) + 1)
+    return response, 429
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        # Sync flush so each chunk (an SSE event, an NDJSON line) reaches the
+        # client as soon as it's produced
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.after_request
+def compress_response(response):
+    if (not COMPRESS_RESPONSES or response.status_code != 200 or response.direct_passthrough
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    if accepted_encoding(["gzip"]) != "gzip":
+        return response
+    if response.is_streamed:
+        response.response = gzip_stream(response.response)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(gzip.compress(data, 6))
+    response.headers["Content-Encoding"] = "gzip"
+    response.headers.pop("Content-Length", None)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    start = request.environ.get("mp3server.start")
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    status = f"{response.status_code // 100}xx"
+    inc("http_requests_total", route=route, method=request.method, status=status)
+    if start is not None:
+        observe("http_request_seconds", time.perf_counter() - start, route=route, status=status)
+    response.headers["X-Request-ID"] = g.request_id
+    return response
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(collect_metrics()), mimetype="text/plain; version=0.0.4")
+
+def get_request_url():
+    # Accept JSON ({ "url": "..." }) or form (url=...); anything but a
+    # non-empty string counts as missing
+    if request.is_json:
+        data = request.get_json(silent=True)
+        url = data.get("url") if isinstance(data, dict) else None
+    else:
+        url = request.form.get("url")
+    if not isinstance(url, str) or not url.strip():
+        return None
+    return url.strip()
+
+def queue_download(kind):
+    url = get_request_url()
+    if not url:
+        return jsonify({"error": "URL is required"}), 400
+
+    if not disk_has_room(JOB_KINDS[kind]["folder"]):
+        return jsonify({"error": "Not enough free disk space on the server"}), 507
+
+    job = submit_job(kind, url, client_id())
+    if job is None:
+        response = jsonify({"error": "Download queue is full, try again shortly"})
+        response.headers["Retry-After"] = "5"
+        return response, 429
+
+    return jsonify({
+        "job": job["id"],
+        "status_url": f"/jobs/{job['id']}",
+        "events_url": f"/jobs/{job['id']}/events",
+    }), 202
+
+@app.route("/download", methods=["POST"])
+def handle_download():
+    return queue_download("audio")
+
+@app.route("/download-mp4", methods=["POST"])
+def handle_mp4_download():
+    return queue_download("video")
 
-    output_path = os.path.join(DOWNLOAD_FOLDER, safe_title)
+# Batches by id, kept so a client can resume one after a partial failure
+BATCHES = {}
 
-    command = [
-        "yt-dlp",
-        "--extract-audio",
-        "--audio-format", "mp3",
-        "--audio-quality", "0",
-        "-o", output_path,
-        url
-    ]
+def save_batch(batch):
+    with _jobs_db_lock:
+        db = jobs_db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?)", (
+                batch["id"], batch["kind"], json.dumps(batch["urls"]), json.dumps(batch["results"])))
 
-    try:
-        print(f"Downloading: {url}")
-        subprocess.run(command, check=True)
-        return safe_title
-    except subprocess.CalledProcessError as e:
-        raise Exception("Download failed")
+def load_batch(batch_id):
+    if batch_id in BATCHES:
+        return BATCHES[batch_id]
+    with _jobs_db_lock:
+        row = jobs_db().execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+    if row is None:
+        return None
+    results = {int(index): line for index, line in json.loads(row[3]).items()}
+    batch = {"id": row[0], "kind": row[1], "urls": json.loads(row[2]), "results": results}
+    BATCHES[batch_id] = batch
+    return batch
+
+def batch_results(batch, client):
+    """Run a batch through the job queue and yield one NDJSON line per item.
+
+    Items are submitted as queue space allows and reported in completion
+    order. Items that succeeded in an earlier run are reported again without
+    being resubmitted.
+    """
+    yield json.dumps({"batch": batch["id"], "kind": batch["kind"], "items": len(batch["urls"])}) + "\n"
 
-def get_file_info(file_path):
-    """Get file information for the Finder app"""
+    listener = queue.Queue()
+    pending = []
+    for index, url in enumerate(batch["urls"]):
+        previous = batch["results"].get(index)
+        if previous and previous["state"] == "done":
+            yield json.dumps(previous) + "\n"
+        else:
+            pending.append((index, url))
+    pending.reverse()
+
+    active = {}
     try:
-        stat = os.stat(file_path)
-        return {
-            "name": os.path.basename(file_path),
-            "size": stat.st_size,
-            "modifiedDate": datetime.fromtimestamp(stat.st_mtime).isoformat(),
-            "isDirectory": os.path.isdir(file_path)
-        }
-    except Exception as e:
-        print(f"Error getting file info for {file_path}: {e}")
-        return None
-    
-def download_mp4(url):
-    # Get title first
-    title_cmd = [
-        "yt-dlp",
-        "--get-title",
-        "--no-warnings",
-        url
-    ]
+        while pending or active:
+            while pending:
+                index, url = pending[-1]
+                job = submit_job(batch["kind"], url, client)
+                if job is None:
+                    break  # queue full; submit more as jobs finish
+                pending.pop()
+                with JOBS_LOCK:
+                    JOB_SUBSCRIBERS.setdefault(job["id"], set()).add(listener)
+                active.setdefault(job["id"], (job, []))[1].append(index)
+
+            try:
+                listener.get(timeout=1)
+            except queue.Empty:
+                pass
+
+            for job_id, (job, indexes) in list(active.items()):
+                view = job_view(get_job(job_id) or job)
+                if view["state"] not in ("done", "error"):
+                    continue
+                del active[job_id]
+                for index in indexes:
+                    line = {
+                        "index": index,
+                        "url": batch["urls"][index],
+                        "job": job_id,
+                        "state": view["state"],
+                        "result": view["result"],
+                        "error": view["error"],
+                    }
+                    batch["results"][index] = line
+                    save_batch(batch)
+                    yield json.dumps(line) + "\n"
+    finally:
+        with JOBS_LOCK:
+            for job_id in active:
+                JOB_SUBSCRIBERS.get(job_id, set()).discard(listener)
+
+    failed = sum(1 for r in batch["results"].values() if r["state"] != "done")
+    yield json.dumps({"batch": batch["id"], "done": len(batch["results"]) - failed, "failed": failed}) + "\n"
+
+@app.route("/download/batch", methods=["POST"])
+def handle_batch_download():
+    """Download many URLs, or a whole playlist, streaming NDJSON results.
+
+    JSON body: {"urls": [...]} or {"playlist": "..."}, optional "kind"
+    ("audio" or "video"), or {"resume": "<batch id>"} to retry what failed.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
 
+    if data.get("resume"):
+        if not isinstance(data["resume"], str):
+            return jsonify({"error": "resume must be a batch id"}), 400
+        batch = load_batch(data["resume"])
+        if batch is None:
+            return jsonify({"error": "Batch not found"}), 404
+    else:
+        kind = data.get("kind", "audio")
+        if not isinstance(kind, str) or kind not in JOB_KINDS:
+            return jsonify({"error": "kind must be 'audio' or 'video'"}), 400
+
+        urls = data.get("urls")
+        if data.get("playlist"):
+            if not isinstance(data["playlist"], str):
+                return jsonify({"error": "playlist must be a URL"}), 400
+            try:
+                urls = expand_playlist(data["playlist"])
+            except Exception:
+                return jsonify({"error": "Failed to read playlist"}), 502
+        if not urls or not isinstance(urls, list):
+            return jsonify({"error": "urls or playlist is required"}), 400
+        if len(urls) > BATCH_MAX_ITEMS:
+            return jsonify({"error": f"Too many items (max {BATCH_MAX_ITEMS})"}), 413
+        if not all(isinstance(u, str) and u.strip() for u in urls):
+            return jsonify({"error": "urls must be non-empty strings"}), 400
+
+        batch = {"id": uuid.uuid4().hex, "kind": kind, "urls": urls, "results": {}}
+        BATCHES[batch["id"]] = batch
+        save_batch(batch)
+
+    if not disk_has_room(JOB_KINDS[batch["kind"]]["folder"]):
+        return jsonify({"error": "Not enough free disk space on the server"}), 507
+
+    response = Response(batch_results(batch, client_id()), mimetype="application/x-ndjson")
+    response.headers["X-Batch-Id"] = batch["id"]
+    return response
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_view(job))
+
+def remote_job_events(job):
+    # Owned by another worker process: follow its record in the job store
+    last = None
+    while True:
+        if job["updated"] != last:
+            last = job["updated"]
+            yield f"data: {json.dumps(job_view(job))}\n\n"
+        if job["state"] in ("done", "error"):
+            return
+        time.sleep(1)
+        job = load_job(job["id"]) or job
+
+def job_events(job):
+    if job["id"] not in JOBS:
+        yield from remote_job_events(job)
+        return
+
+    listener = queue.Queue(maxsize=64)
+    with JOBS_LOCK:
+        JOB_SUBSCRIBERS.setdefault(job["id"], set()).add(listener)
     try:
-        result = subprocess.run(
-            title_cmd, check=True,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        raw_title = result.stdout.decode().strip()
-        safe_title = sanitize_filename(raw_title) + ".mp4"
-    except subprocess.CalledProcessError:
-        raise Exception("Failed to retrieve video title")
+        view = job_view(job)
+        while True:
+            yield f"data: {json.dumps(view)}\n\n"
+            if view["state"] in ("done", "error"):
+                return
+            try:
+                view = listener.get(timeout=15)
+            except queue.Empty:
+                # Doubles as a keep-alive for idle connections
+                view = job_view(job)
+    finally:
+        with JOBS_LOCK:
+            subscribers = JOB_SUBSCRIBERS.get(job["id"], set())
+            subscribers.discard(listener)
+            if not subscribers:
+                JOB_SUBSCRIBERS.pop(job["id"], None)
 
-    output_path = os.path.join(VIDEO_DOWNLOAD_FOLDER, safe_title)
+@app.route("/jobs/<job_id>/events")
+def job_event_stream(job_id):
+    """Server-Sent Events: one message per job update until it finishes"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    response = Response(job_events(job), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-    command = [
-        "yt-dlp",
-        "-f bv*+ba/best",
-        "-N", "8",
-        "--no-write-thumbnail",
-        "--no-write-info-json",
+def stream_audio(url, key):
+    """Pipe yt-dlp's audio into ffmpeg and yield mp3 chunks as they arrive.
+
+    The mp3 is written to DOWNLOAD_FOLDER alongside the response and indexed
+    under key once the stream completes, so replays are cache hits.
+    """
+    token = uuid.uuid4().hex
+    # Both tools' stderr is captured and only logged (tail) on failure
+    errors = tempfile.TemporaryFile()
+    part_path = os.path.join(DOWNLOAD_FOLDER, f".stream-{token}.mp3.part")
+    title_path = os.path.join(DOWNLOAD_FOLDER, f".stream-{token}.title")
+    fetch = subprocess.Popen([
+        YT_DLP,
+        "-f", "bestaudio/best",
+        "--quiet",
         "--no-warnings",
-        "-o", output_path,
+        "--no-playlist",
+        "--print-to-file", "before_dl:title", title_path,
+        "-o", "-",
         url
-    ]
+    ], stdout=subprocess.PIPE, stderr=errors)
+    transcode = subprocess.Popen(niced([
+        FFMPEG,
+        "-loglevel", "error",
+        "-i", "pipe:0",
+        "-vn",
+        "-codec:a", "libmp3lame",
+        "-q:a", "0",
+        *ffmpeg_args(),
+        "-f", "mp3",
+        "pipe:1"
+    ]), stdin=fetch.stdout, stdout=subprocess.PIPE, stderr=errors)
+    # ffmpeg owns the read end of the pipe now
+    fetch.stdout.close()
 
+    inc("active_subprocesses", tool="yt-dlp")
+    inc("active_subprocesses", tool="ffmpeg")
+    completed = False
     try:
-        subprocess.run(command, check=True)
-        return safe_title
-    except subprocess.CalledProcessError:
-        raise Exception("MP4 download failed")
+        with open(part_path, "wb") as part:
+            while True:
+                chunk = transcode.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                part.write(chunk)
+                yield chunk
+        completed = transcode.wait() == 0 and fetch.wait() == 0
+    finally:
+        # Also reached when the client disconnects mid-stream
+        for proc in (fetch, transcode):
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        inc("active_subprocesses", -1, tool="yt-dlp")
+        inc("active_subprocesses", -1, tool="ffmpeg")
+        transcode.stdout.close()
+        if not completed:
+            errors.seek(max(os.fstat(errors.fileno()).st_size - 4096, 0))
+            log.warning("Stream of %s did not complete", url,
+                        extra={"output": errors.read().decode(errors="replace")})
+        errors.close()
+        try:
+            if completed:
+                with open(title_path) as f:
+                    raw_title = f.read().strip()
+                filename = sanitize_filename(raw_title) + ".mp3"
+                os.replace(part_path, os.path.join(DOWNLOAD_FOLDER, filename))
+                cache_store(key, DOWNLOAD_FOLDER, filename)
+        except OSError as e:
+            log.warning("Could not keep streamed file for %s: %s", url, e)
+        for path in (part_path, title_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+@app.route("/info", methods=["GET", "DELETE"])
+def media_info():
+    """Extractor metadata for ?url=, from the info cache when it's fresh.
+
+    ?refresh=1 re-runs the extractor; DELETE drops the cached entry.
+    """
+    url = request.args.get("url")
+    if not url:
+        return jsonify({"error": "URL is required"}), 400
 
+    if request.method == "DELETE":
+        invalidate_info(":".join(canonical_media_id(url)))
+        return "", 204
 
-def is_safe_path(path):
-    """Check if the path is safe to access (only within screenshots folder)"""
     try:
-        # Resolve the requested path
-        requested_path = os.path.realpath(path)
-        screenshots_path = os.path.realpath(SCREENSHOTS_FOLDER)
-        
-        # Check if the requested path is within the screenshots folder
-        return requested_path.startswith(screenshots_path)
-    except Exception:
-        return False
+        info, fetched, hit = get_info(url, refresh=request.args.get("refresh") == "1")
+    except Exception as e:
+        log.warning("Info lookup failed for %s: %s", url, e)
+        return jsonify({"error": "Failed to read media info"}), 502
 
-@app.route("/download", methods=["POST"])
-def handle_download():
-    # Accept JSON ({ "url": "..." }) or form (url=...)
-    url = None
-    if request.is_json:
-        data = request.get_json(silent=True) or {}
-        url = data.get("url")
-    else:
-        url = request.form.get("url")
+    response = jsonify(dict(info, fetched=datetime.fromtimestamp(fetched).isoformat()))
+    response.headers["X-Cache"] = "HIT" if hit else "MISS"
+    remaining = max(int(fetched + INFO_CACHE_TTL - time.time()), 0)
+    response.headers["Cache-Control"] = f"private, max-age={remaining}"
+    return response
 
+@app.route("/stream/mp3")
+def stream_mp3():
+    url = request.args.get("url")
     if not url:
         return jsonify({"error": "URL is required"}), 400
 
-    try:
-        filename = download_audio(url)
-        file_path = os.path.join(DOWNLOAD_FOLDER, filename)
-        music_auto_import = "/Users/jamilkhalaf/Music/Music/Media.localized/Automatically Add to Music.localized"
+    key = media_key(url, "mp3")
+    cached = cache_lookup(key)
+    inc("cache_requests_total", cache="media", result="hit" if cached else "miss")
+    if cached:
+        full_path = os.path.join(DOWNLOAD_FOLDER, cached)
+        return send_path(full_path, os.stat(full_path), as_attachment=False, mimetype="audio/mpeg")
 
-        # Copy into Apple Music's auto-import folder
-        shutil.copy(file_path, music_auto_import)
+    if not disk_has_room(DOWNLOAD_FOLDER):
+        return jsonify({"error": "Not enough free disk space on the server"}), 507
 
-        return jsonify({"file": filename, "status": "imported to Apple Music"})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return Response(stream_audio(url, key), mimetype="audio/mpeg")
 
-@app.route("/download-mp4", methods=["POST"])
-def handle_mp4_download():
-    url = None
-    if request.is_json:
-        data = request.get_json(silent=True) or {}
-        url = data.get("url")
-    else:
-        url = request.form.get("url")
+def accepted_encoding(available):
+    """The client's preferred encoding among available, or identity"""
+    best, best_quality = "identity", 0
+    for encoding in available:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
 
-    if not url:
-        return jsonify({"error": "URL is required"}), 400
+def static_page(view):
+    """Build the page view returns once, with a gzip and (when the brotli
+    module is installed) a brotli variant, and serve whichever the client
+    accepts with an ETag and Cache-Control"""
+    body = view().encode()
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    variants = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
 
-    try:
-        filename = download_mp4(url)
-        return jsonify({
-            "file": filename,
-            "saved_to": VIDEO_DOWNLOAD_FOLDER
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    @functools.wraps(view)
+    def serve_page():
+        encoding = accepted_encoding([e for e in ("br", "gzip") if e in variants])
+        response = Response(mimetype="text/html")
+        response.set_etag(digest if encoding == "identity" else f"{digest}-{encoding}")
+        response.headers["Cache-Control"] = f"public, max-age={PAGE_MAX_AGE}"
+        response.vary.add("Accept-Encoding")
+        if request.if_none_match.contains(response.get_etag()[0]):
+            response.status_code = 304
+            return response
+        response.set_data(variants[encoding])
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        return response
+    return serve_page
 
 @app.route("/mp4", methods=["GET"])
+@static_page
 def mp4_page():
     return """
 <!DOCTYPE html>
@@ -196,6 +2429,25 @@ def mp4_page():
   </div>
 
 <script>
+function describeProgress(p) {
+  if (p.stage === "downloading" && p.percent != null) return "Downloading… " + p.percent + "%";
+  if (p.stage === "postprocessing") return "Processing (" + p.postprocessor + ")…";
+  if (p.stage === "queued") return "Waiting in queue…";
+  return "Downloading…";
+}
+
+function waitForJob(eventsUrl, onProgress) {
+  return new Promise((resolve, reject) => {
+    const events = new EventSource(eventsUrl);
+    events.onmessage = (e) => {
+      const job = JSON.parse(e.data);
+      if (job.state === "done") { events.close(); resolve(job.result); }
+      else if (job.state === "error") { events.close(); reject(new Error(job.error || "Failed")); }
+      else onProgress(job.progress);
+    };
+  });
+}
+
 async function go() {
   const url = document.getElementById('url').value.trim();
   const status = document.getElementById('status');
@@ -210,9 +2462,10 @@ async function go() {
       body: JSON.stringify({ url })
     });
 
-    const d = await r.json();
-    if (!r.ok) throw new Error(d.error || "Failed");
+    const queued = await r.json();
+    if (!r.ok) throw new Error(queued.error || "Failed");
 
+    const d = await waitForJob(queued.events_url, p => { status.textContent = describeProgress(p); });
     status.textContent = "Saved to Downloads: " + d.file;
   } catch (e) {
     status.textContent = "Error: " + e.message;
@@ -223,73 +2476,664 @@ async function go() {
 </html>
 """
 
+def file_etag(st):
+    # Strong validator: any rewrite changes the mtime, a replacement the inode
+    return f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+def read_range(f, length):
+    try:
+        while length > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def requested_range(st, etag):
+    """Return (start, length) for a satisfiable single Range, None for the
+    whole file, or False when the range can't be satisfied"""
+    if request.range is None or request.range.units != "bytes" or len(request.range.ranges) != 1:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and int(if_range.date.timestamp()) != int(st.st_mtime):
+        return None
+    byte_range = request.range.range_for_length(st.st_size)
+    if byte_range is None:
+        return False
+    start, stop = byte_range
+    return start, stop - start
+
+def send_path(full_path, st, as_attachment=True, mimetype=None, etag=None,
+              cache_control=FILE_CACHE_CONTROL, fd=None):
+    """Send a file with ETag/Range support, given its stat result.
+
+    The body goes out through the server's wsgi.file_wrapper when it has one
+    (gunicorn uses sendfile(2) from the current offset for Content-Length
+    bytes), so even ranged responses skip Python buffers there. etag defaults
+    to one derived from st. An open fd for the file is used (and closed)
+    instead of opening full_path again.
+    """
+    f = os.fdopen(fd, "rb") if fd is not None else None
+    etag = etag or file_etag(st)
+    filename = os.path.basename(full_path)
+    response = Response(mimetype=mimetype or mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                        direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = int(st.st_mtime)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Cache-Control"] = cache_control
+    if as_attachment:
+        try:
+            filename.encode("ascii")
+            response.headers.set("Content-Disposition", "attachment", filename=filename)
+        except UnicodeEncodeError:
+            response.headers.set("Content-Disposition", "attachment",
+                                 filename=filename.encode("ascii", "replace").decode(),
+                                 **{"filename*": "UTF-8''" + urllib.parse.quote(filename)})
+
+    if request.if_none_match.contains(etag):
+        if f is not None:
+            f.close()
+        response.status_code = 304
+        return response
+
+    byte_range = requested_range(st, etag)
+    if byte_range is False:
+        if f is not None:
+            f.close()
+        response.status_code = 416
+        response.headers["Content-Range"] = f"bytes */{st.st_size}"
+        return response
+    start, length = byte_range or (0, st.st_size)
+    if byte_range:
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{start + length - 1}/{st.st_size}"
+
+    if f is None:
+        f = open(full_path, "rb")
+    f.seek(start)
+    pin(full_path)
+    response.call_on_close(lambda: unpin(full_path))
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and file_wrapper is not FileWrapper:
+        response.response = file_wrapper(f, FILE_CHUNK_SIZE)
+    else:
+        response.response = read_range(f, length)
+    response.content_length = length
+    inc("file_bytes_served_total", length, route=request.url_rule.rule if request.url_rule else "")
+    return response
+
 @app.route("/file/<filename>")
 def serve_file(filename):
+    full_path = safe_join(DOWNLOAD_FOLDER, filename)
     try:
-        return send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True)
+        if full_path is None:
+            raise FileNotFoundError(filename)
+        st = os.stat(full_path)
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(filename)
     except FileNotFoundError:
         return jsonify({"error": "File not found"}), 404
+    touch_media(DOWNLOAD_FOLDER, filename)
+    return send_path(full_path, st)
+
+def make_thumbnail(src, dest, size, fmt):
+    """Runs in a thumbnail worker process; writes the thumbnail to dest"""
+    with Image.open(src) as im:
+        # Let the JPEG decoder downscale while decoding
+        im.draft("RGB", (size, size))
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((size, size))
+        if fmt == "jpeg" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        tmp = f"{dest}.{os.getpid()}.part"
+        im.save(tmp, "WEBP" if fmt == "webp" else "JPEG", quality=80)
+    os.replace(tmp, dest)
+    return os.path.getsize(dest)
+
+_thumb_pool = None
+_thumb_lock = threading.Lock()
+# Bytes in THUMB_FOLDER, counted once on first use then kept up to date
+_thumb_cache_bytes = None
+
+def thumb_cache_usage():
+    # Called with _thumb_lock held
+    global _thumb_cache_bytes
+    if _thumb_cache_bytes is None:
+        os.makedirs(THUMB_FOLDER, exist_ok=True)
+        _thumb_cache_bytes = sum(e.stat().st_size for e in os.scandir(THUMB_FOLDER) if e.is_file())
+    return _thumb_cache_bytes
+
+def evict_thumbnails():
+    """Drop least recently served thumbnails until under THUMB_CACHE_MAX_BYTES"""
+    global _thumb_cache_bytes
+    with _thumb_lock:
+        if thumb_cache_usage() <= THUMB_CACHE_MAX_BYTES:
+            return
+        # Hits set the access time, so the oldest one is least recently used
+        entries = sorted((e for e in os.scandir(THUMB_FOLDER) if e.is_file()),
+                         key=lambda e: e.stat().st_atime)
+        for entry in entries:
+            if _thumb_cache_bytes <= THUMB_CACHE_MAX_BYTES * 0.9:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            _thumb_cache_bytes -= size
+
+def generate_thumbnail(src, dest, size, fmt):
+    global _thumb_pool, _thumb_cache_bytes
+    with _thumb_lock:
+        thumb_cache_usage()
+        if _thumb_pool is None:
+            _thumb_pool = ProcessPoolExecutor(max_workers=THUMB_WORKERS,
+                                              mp_context=multiprocessing.get_context("spawn"))
+        pool = _thumb_pool
+    try:
+        written = pool.submit(make_thumbnail, src, dest, size, fmt).result()
+    except BrokenProcessPool:
+        with _thumb_lock:
+            if _thumb_pool is pool:
+                _thumb_pool = None
+        raise Exception("Thumbnail worker crashed")
+    with _thumb_lock:
+        _thumb_cache_bytes += written
+    evict_thumbnails()
+
+@app.route("/thumb/<path:file_path>")
+def thumbnail(file_path):
+    """Downscaled preview of an image in the screenshots folder"""
+    if Image is None:
+        return jsonify({"error": "Thumbnails need Pillow installed"}), 501
+
+    if os.path.splitext(file_path)[1].lower() not in THUMB_EXTENSIONS:
+        return jsonify({"error": "Not an image"}), 400
+    try:
+        full_path, st = resolve_screenshot(file_path)
+    except PermissionError:
+        return jsonify({"error": "Access denied - path outside screenshots folder"}), 403
+    except FileNotFoundError:
+        return jsonify({"error": f"File not found: {file_path}"}), 404
+    if not stat.S_ISREG(st.st_mode):
+        return jsonify({"error": "Not an image"}), 400
+
+    try:
+        requested = int(request.args.get("size", 256))
+    except ValueError:
+        return jsonify({"error": "Invalid size"}), 400
+    # Snap to a few sizes so the cache doesn't fill with near-duplicates
+    size = next((s for s in THUMB_SIZES if s >= requested), THUMB_SIZES[-1])
+    fmt = request.args.get("format")
+    if fmt not in ("webp", "jpeg"):
+        fmt = "webp" if request.accept_mimetypes["image/webp"] else "jpeg"
+
+    # Keyed by the source's identity, so an edited image gets a new thumbnail
+    key = hashlib.sha1(f"{full_path}\0{file_etag(st)}\0{size}\0{fmt}".encode()).hexdigest()
+    dest = os.path.join(THUMB_FOLDER, f"{key}.{fmt}")
+    try:
+        thumb_st = os.stat(dest)
+        # Recency goes in the access time; the mtime stays as Last-Modified
+        os.utime(dest, ns=(time.time_ns(), thumb_st.st_mtime_ns))
+        inc("cache_requests_total", cache="thumbnail", result="hit")
+    except FileNotFoundError:
+        inc("cache_requests_total", cache="thumbnail", result="miss")
+        try:
+            single_flight(f"thumb:{key}", lambda: os.path.exists(dest) or generate_thumbnail(full_path, dest, size, fmt))
+            thumb_st = os.stat(dest)
+        except Exception as e:
+            log.warning("Thumbnail failed for %s: %s", full_path, e)
+            return jsonify({"error": "Could not make thumbnail"}), 500
+
+    # The key already names these exact bytes
+    response = send_path(dest, thumb_st, as_attachment=False, mimetype=f"image/{fmt}",
+                         etag=key, cache_control=THUMB_CACHE_CONTROL)
+    response.vary.add("Accept")
+    return response
+
+def scan_directory(path):
+    """Read a directory with scandir; one stat per entry, hidden files skipped.
+
+    Symlinks are left out too: resolve_screenshot refuses to open them, so
+    listing them would only offer links that 403.
+    """
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.') or entry.is_symlink():
+                continue
+            try:
+                st = entry.stat()
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            entries.append({
+                "name": entry.name,
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "modifiedDate": datetime.fromtimestamp(st.st_mtime).isoformat(),
+                "isDirectory": is_dir,
+            })
+    return entries
+
+LISTING_SORTS = {
+    "name": lambda e: (e["name"].lower(), e["name"]),
+    "size": lambda e: (e["size"], e["name"]),
+    "modified": lambda e: (e["mtime"], e["name"]),
+}
+# Types of each sort key's parts, to check cursors clients send back
+LISTING_CURSOR_TYPES = {
+    "name": (str, str),
+    "size": (int, str),
+    "modified": ((int, float), str),
+}
+
+_listing_cache = collections.OrderedDict()
+_listing_lock = threading.Lock()
+
+def cached_listing(path, sort, st=None):
+    """Return (entries, sort keys) for a directory in ascending sort order.
+
+    Adding, removing or renaming an entry bumps the directory's mtime, which
+    invalidates the cached scan. st saves a stat when the caller has one.
+    """
+    mtime_ns = (st or os.stat(path)).st_mtime_ns
+    with _listing_lock:
+        cached = _listing_cache.get(path)
+        if cached and cached["mtime_ns"] == mtime_ns:
+            _listing_cache.move_to_end(path)
+        else:
+            cached = None
+    inc("cache_requests_total", cache="listing", result="hit" if cached else "miss")
+
+    if cached is None:
+        cached = {"mtime_ns": mtime_ns, "entries": scan_directory(path), "sorted": {}}
+        with _listing_lock:
+            _listing_cache[path] = cached
+            while len(_listing_cache) > LISTING_CACHE_SIZE:
+                _listing_cache.popitem(last=False)
+
+    ordered = cached["sorted"].get(sort)
+    if ordered is None:
+        sort_key = LISTING_SORTS[sort]
+        entries = sorted(cached["entries"], key=sort_key)
+        ordered = cached["sorted"][sort] = (entries, [sort_key(e) for e in entries])
+    return ordered
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    key = json.loads(base64.urlsafe_b64decode(padded))
+    if not isinstance(key, list):
+        raise ValueError("cursor is not a list")
+    return tuple(key)
+
+def listing_cursor(cursor, sort):
+    """Decode a listing cursor, checking it has the shape of sort's keys; a
+    cursor from another sort would otherwise fail comparing in bisect"""
+    key = decode_cursor(cursor)
+    types = LISTING_CURSOR_TYPES[sort]
+    if len(key) != len(types) or not all(
+            isinstance(part, t) and not isinstance(part, bool) for part, t in zip(key, types)):
+        raise ValueError(f"not a {sort} cursor")
+    return key
+
+def page_listing(entries, keys, cursor, limit, descending):
+    """Slice one page after cursor (the sort key of the last entry seen)"""
+    if descending:
+        end = bisect.bisect_left(keys, cursor) if cursor else len(keys)
+        start = max(end - limit, 0)
+        page = entries[start:end][::-1]
+        last = start if start > 0 else None
+    else:
+        start = bisect.bisect_right(keys, cursor) if cursor else 0
+        end = min(start + limit, len(entries))
+        page = entries[start:end]
+        last = end - 1 if end < len(entries) else None
+    next_cursor = encode_cursor(keys[last]) if last is not None and page else None
+    return page, next_cursor
+
+def wants_json():
+    # The Finder client asks for JSON; browsers get the HTML page
+    if request.args.get("format") == "json":
+        return True
+    best = request.accept_mimetypes.best_match(["text/html", "application/json"])
+    return best == "application/json"
+
+# Indexed folders: (path, whether subdirectories are indexed too)
+SEARCH_ROOTS = {
+    "songs": (DOWNLOAD_FOLDER, False),
+    "videos": (VIDEO_DOWNLOAD_FOLDER, False),
+    "screenshots": (SCREENSHOTS_FOLDER, True),
+}
+# macOS packages that look like directories but aren't browsable folders
+SEARCH_SKIP_SUFFIXES = (".photoslibrary", ".photolibrary", ".app", ".bundle")
+
+_search_db = None
+_search_lock = threading.Lock()
+
+def open_search_db():
+    db = sqlite3.connect(SEARCH_DB, check_same_thread=False, timeout=5)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    # FTS5 answers a "term"* query from a prefix index only when one exists
+    # for that exact length; without it every matching term is merged, which
+    # is what makes typed-so-far queries slow on large folders
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            root TEXT NOT NULL,
+            path TEXT NOT NULL,
+            dir TEXT NOT NULL,
+            name TEXT NOT NULL,
+            title TEXT,
+            video_id TEXT,
+            duration REAL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            UNIQUE (root, path)
+        );
+        CREATE INDEX IF NOT EXISTS files_dir ON files (root, dir);
+        CREATE TABLE IF NOT EXISTS dirs (
+            root TEXT NOT NULL,
+            path TEXT NOT NULL,
+            parent TEXT,
+            mtime_ns INTEGER NOT NULL,
+            PRIMARY KEY (root, path)
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+            name, title, video_id, root, content='files', content_rowid='id', prefix='2 3 4 5 6 7 8 9 10 11 12');
+        CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts (rowid, name, title, video_id, root)
+            VALUES (new.id, new.name, new.title, new.video_id, new.root);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, name, title, video_id, root)
+            VALUES ('delete', old.id, old.name, old.title, old.video_id, old.root);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_au AFTER UPDATE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, name, title, video_id, root)
+            VALUES ('delete', old.id, old.name, old.title, old.video_id, old.root);
+            INSERT INTO files_fts (rowid, name, title, video_id, root)
+            VALUES (new.id, new.name, new.title, new.video_id, new.root);
+        END;
+    """)
+    if db.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+        raise sqlite3.DatabaseError("search index failed quick_check")
+    return db
+
+def search_db():
+    # Called with _search_lock held. The index only holds what a scan can
+    # find again, so a damaged one is simply thrown away and rebuilt.
+    global _search_db
+    if _search_db is None:
+        try:
+            _search_db = open_search_db()
+        except sqlite3.DatabaseError as e:
+            log.warning("Rebuilding search index: %s", e)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(SEARCH_DB + suffix):
+                    os.remove(SEARCH_DB + suffix)
+            _search_db = open_search_db()
+    return _search_db
+
+def upsert_file(db, root, rel_path, st, **meta):
+    # Scans only refresh size and mtime; titles from downloads are kept
+    columns = {"size": st.st_size, "mtime": st.st_mtime, **meta}
+    names = ", ".join(columns)
+    updates = ", ".join(f"{name} = excluded.{name}" for name in columns)
+    db.execute(
+        f"INSERT INTO files (root, path, dir, name, {names}) VALUES (?, ?, ?, ?, {', '.join('?' * len(columns))}) "
+        f"ON CONFLICT (root, path) DO UPDATE SET {updates}",
+        (root, rel_path, os.path.dirname(rel_path), os.path.basename(rel_path), *columns.values()))
+
+def forget_subtree(db, root, rel_dir):
+    prefix = rel_dir + "/"
+    db.execute("DELETE FROM files WHERE root = ? AND (dir = ? OR substr(dir, 1, ?) = ?)",
+               (root, rel_dir, len(prefix), prefix))
+    db.execute("DELETE FROM dirs WHERE root = ? AND (path = ? OR substr(path, 1, ?) = ?)",
+               (root, rel_dir, len(prefix), prefix))
+
+def scan_search_root(db, root, base, recursive):
+    """Bring one root's rows up to date, re-reading only changed directories"""
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        path = os.path.join(base, rel_dir)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            forget_subtree(db, root, rel_dir)
+            continue
+        known_dirs = [p for (p,) in db.execute(
+            "SELECT path FROM dirs WHERE root = ? AND parent = ?", (root, rel_dir))]
+        row = db.execute("SELECT mtime_ns FROM dirs WHERE root = ? AND path = ?", (root, rel_dir)).fetchone()
+        if row and row[0] == mtime_ns:
+            pending.extend(known_dirs)
+            continue
+
+        known = {name: (size, mtime) for name, size, mtime in db.execute(
+            "SELECT name, size, mtime FROM files WHERE root = ? AND dir = ?", (root, rel_dir))}
+        seen = set()
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive and not entry.name.endswith(SEARCH_SKIP_SUFFIXES):
+                                subdirs.append(os.path.join(rel_dir, entry.name))
+                            continue
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    seen.add(entry.name)
+                    if known.get(entry.name) != (st.st_size, st.st_mtime):
+                        upsert_file(db, root, os.path.join(rel_dir, entry.name), st)
+        except OSError:
+            continue
+        for name in known.keys() - seen:
+            db.execute("DELETE FROM files WHERE root = ? AND path = ?", (root, os.path.join(rel_dir, name)))
+        for gone in set(known_dirs) - set(subdirs):
+            forget_subtree(db, root, gone)
+        db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                   (root, rel_dir, None if rel_dir == "" else os.path.dirname(rel_dir), mtime_ns))
+        pending.extend(subdirs)
+
+def update_search_index():
+    start = time.perf_counter()
+    with _search_lock:
+        db = search_db()
+        for root, (base, recursive) in SEARCH_ROOTS.items():
+            with db:
+                scan_search_root(db, root, base, recursive)
+    observe("stage_seconds", time.perf_counter() - start, stage="index", kind="search", outcome="ok")
+
+def index_download(folder, filename, info):
+    """Record a finished download in the search index with its original title"""
+    root = next((r for r, (base, _) in SEARCH_ROOTS.items() if base == folder), None)
+    if root is None:
+        return
+    try:
+        st = os.stat(os.path.join(folder, filename))
+        with _search_lock:
+            db = search_db()
+            with db:
+                upsert_file(db, root, filename, st, title=info.get("title"),
+                            video_id=info.get("id"), duration=info.get("duration"))
+    except (OSError, sqlite3.Error) as e:
+        log.warning("Could not index %s: %s", filename, e)
+
+_search_caught_up = threading.Event()
+
+def search_indexer():
+    lock_path = os.path.join(STATE_FOLDER, "search.lock")
+    while True:
+        # Worker processes share the index; one scan at a time is enough
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass
+            else:
+                try:
+                    update_search_index()
+                except Exception:
+                    log.exception("Search index update failed")
+        _search_caught_up.set()
+        time.sleep(SEARCH_SCAN_INTERVAL)
+
+_search_indexer_started = False
+_search_indexer_lock = threading.Lock()
+
+def start_search_indexer():
+    global _search_indexer_started
+    with _search_indexer_lock:
+        if not _search_indexer_started:
+            threading.Thread(target=search_indexer, name="search-indexer", daemon=True).start()
+            _search_indexer_started = True
+    # The thread's first pass catches up on changes made while no server
+    # was running; give it a moment before answering the first search
+    _search_caught_up.wait(SEARCH_CATCH_UP_WAIT)
+
+def search_url(root, rel_path):
+    if root == "songs":
+        return "/file/" + urllib.parse.quote(rel_path)
+    if root == "screenshots":
+        return "/download-file/" + urllib.parse.quote(rel_path)
+    return None
+
+@app.route("/search")
+def search():
+    """Ranked search over file names, original titles and video ids.
+
+    ?q= is matched as word prefixes; ?root= limits results to songs, videos
+    or screenshots. Paginated like /files with limit and cursor.
+    """
+    terms = re.findall(r"\w+", request.args.get("q", ""))
+    if not terms:
+        return jsonify({"error": "q is required"}), 400
+    root = request.args.get("root")
+    if root is not None and root not in SEARCH_ROOTS:
+        return jsonify({"error": f"root must be one of {', '.join(SEARCH_ROOTS)}"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+        cursor = request.args.get("cursor")
+        offset = decode_cursor(cursor)[0] if cursor else 0
+        if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+            raise ValueError("search cursor must be an offset")
+    except (ValueError, IndexError):
+        return jsonify({"error": "Invalid limit or cursor"}), 400
+
+    start_search_indexer()
+    match = " ".join(f'"{term}"*' for term in terms)
+    if root:
+        match = f"({match}) AND root : {root}"
+    with _search_lock:
+        db = search_db()
+        matches = db.execute("SELECT count(*) FROM (SELECT 1 FROM files_fts WHERE files_fts MATCH ? LIMIT ?)",
+                             (match, SEARCH_RANK_LIMIT + 1)).fetchone()[0]
+        # Title matches count most, then the file name, then the video id
+        order = "bm25(files_fts, 2.0, 4.0, 1.0, 0.0)" if matches <= SEARCH_RANK_LIMIT else "rowid DESC"
+        ids = [rowid for (rowid,) in db.execute(
+            f"SELECT rowid FROM files_fts WHERE files_fts MATCH ? ORDER BY {order} LIMIT ? OFFSET ?",
+            (match, limit + 1, offset))]
+        found = {row[0]: row[1:] for row in db.execute(
+            f"SELECT id, root, path, name, title, video_id, duration, size, mtime FROM files "
+            f"WHERE id IN ({', '.join('?' * len(ids))})", ids)}
+    rows = [found[rowid] for rowid in ids if rowid in found]
+
+    return jsonify({
+        "items": [{
+            "root": r[0],
+            "path": r[1],
+            "name": r[2],
+            "title": r[3],
+            "videoId": r[4],
+            "duration": r[5],
+            "size": r[6],
+            "modifiedDate": datetime.fromtimestamp(r[7]).isoformat(),
+            "url": search_url(r[0], r[1]),
+        } for r in rows[:limit]],
+        "nextCursor": encode_cursor([offset + limit]) if len(ids) > limit else None,
+    })
 
 @app.route("/files/<path:directory>")
 def list_files(directory):
     """List files in a directory for the Finder app - restricted to screenshots folder only"""
     try:
         # Decode the directory path
-        import urllib.parse
-        directory = urllib.parse.unquote(directory)
-        print(f"Requested directory: {directory}")
-        
-        # Handle root path - always show screenshots folder
-        if directory == "" or directory == "/":
-            full_path = SCREENSHOTS_FOLDER
-        else:
-            # Build the full path within screenshots folder
-            if directory.startswith("/"):
-                directory = directory[1:]  # Remove leading slash
-            full_path = os.path.join(SCREENSHOTS_FOLDER, directory)
-        
-        # Resolve any symbolic links and normalize the path
-        full_path = os.path.realpath(full_path)
-        screenshots_path = os.path.realpath(SCREENSHOTS_FOLDER)
-        
-        print(f"Screenshots folder: {screenshots_path}")
-        print(f"Full resolved path: {full_path}")
-        
-        # Security check - ensure we're only accessing files within the screenshots folder
-        if not full_path.startswith(screenshots_path):
-            print(f"Access denied: {full_path} is outside {screenshots_path}")
+        directory = urllib.parse.unquote(directory).lstrip("/")
+
+        # Security check - only paths within the screenshots folder resolve
+        try:
+            full_path, st = resolve_screenshot(directory)
+        except PermissionError:
+            log.warning("Access denied: %s is outside %s", directory, SCREENSHOTS_FOLDER)
             return jsonify({"error": "Access denied - path outside screenshots folder"}), 403
-        
-        if not os.path.exists(full_path):
-            print(f"Directory not found: {full_path}")
+        except FileNotFoundError:
+            log.info("Directory not found: %s", directory)
             return jsonify({"error": f"Directory not found: {directory}"}), 404
-        
-        if not os.path.isdir(full_path):
-            print(f"Not a directory: {full_path}")
+
+        if not stat.S_ISDIR(st.st_mode):
+            log.info("Not a directory: %s", full_path)
             return jsonify({"error": "Not a directory"}), 400
         
-        files = []
+        sort = request.args.get("sort", "name")
+        if sort not in LISTING_SORTS:
+            return jsonify({"error": f"sort must be one of {', '.join(LISTING_SORTS)}"}), 400
+        descending = request.args.get("order", "asc") == "desc"
         try:
-            for item in os.listdir(full_path):
-                # Skip hidden files (starting with .)
-                if item.startswith('.'):
-                    continue
-                    
-                item_path = os.path.join(full_path, item)
-                file_info = get_file_info(item_path)
-                if file_info:
-                    files.append(file_info)
-                    print(f"Found: {item} ({'dir' if file_info['isDirectory'] else 'file'})")
+            limit = min(max(int(request.args.get("limit", LISTING_PAGE_SIZE)), 1), LISTING_MAX_PAGE_SIZE)
+            cursor = request.args.get("cursor")
+            cursor = listing_cursor(cursor, sort) if cursor else None
+        except (ValueError, TypeError):
+            return jsonify({"error": "Invalid limit or cursor"}), 400
+
+        try:
+            entries, keys = cached_listing(full_path, sort, st)
         except PermissionError:
-            print(f"Permission denied accessing: {full_path}")
+            log.warning("Permission denied accessing: %s", full_path)
             return jsonify({"error": "Permission denied"}), 403
-        
-        print(f"Returning {len(files)} files/directories")
-        
-        # Return HTML interface instead of JSON
+
+        files, next_cursor = page_listing(entries, keys, cursor, limit, descending)
+
         current_path = directory if directory else ""
         parent_path = "/".join(current_path.split("/")[:-1]) if "/" in current_path else ""
-        
+
+        if wants_json():
+            return jsonify({
+                "path": current_path,
+                "total": len(entries),
+                "items": [
+                    {k: f[k] for k in ("name", "size", "modifiedDate", "isDirectory")}
+                    for f in files
+                ],
+                "nextCursor": next_cursor,
+            })
+
+        # Return HTML interface instead of JSON
+        query = {"sort": sort, "order": "desc" if descending else "asc", "limit": limit}
+        next_link = ""
+        if next_cursor:
+            next_query = urllib.parse.urlencode({**query, "cursor": next_cursor})
+            next_link = f'<a href="/files/{current_path}?{next_query}">Next page ➡️</a>'
+        sort_links = " ".join(
+            f'<a href="/files/{current_path}?{urllib.parse.urlencode({**query, "sort": name})}">{name}</a>'
+            for name in LISTING_SORTS
+        )
+
         html_content = f"""
         <!DOCTYPE html>
         <html lang="en">
@@ -358,6 +3202,12 @@ def list_files(directory):
                     background: #e9ecef;
                     border-radius: 8px;
                     font-size: 20px;
+                    overflow: hidden;
+                }}
+                .file-icon img {{
+                    width: 100%;
+                    height: 100%;
+                    object-fit: cover;
                 }}
                 .file-info {{
                     flex: 1;
@@ -427,10 +3277,14 @@ def list_files(directory):
                 </div>
                 
                 <div class="stats">
-                    📊 {len(files)} items found
+                    📊 {len(entries)} items found • Sort by: {sort_links}
                 </div>
                 
-                <div class="file-list">
+                <form class="file-list" action="/download-zip/{current_path}" method="get">
+                    <div class="stats">
+                        <button type="submit" class="btn btn-secondary">⬇️ Download selected as ZIP</button>
+                        <a href="/download-zip/{current_path}" class="btn btn-secondary">⬇️ Download folder as ZIP</a>
+                    </div>
         """
         
         if not files:
@@ -461,9 +3315,17 @@ def list_files(directory):
                     file_size = file_info['size']
                     size_str = f"{file_size / (1024*1024):.1f} MB" if file_size > 1024*1024 else f"{file_size / 1024:.1f} KB"
                     
+                    item_path = urllib.parse.quote(f"{current_path + '/' if current_path else ''}{file_info['name']}")
+                    if Image is not None and os.path.splitext(file_info['name'])[1].lower() in THUMB_EXTENSIONS:
+                        version = f"{int(file_info['mtime'])}-{file_size}"
+                        icon = f'<img src="/thumb/{item_path}?size=128&v={version}" loading="lazy" alt="">'
+                    else:
+                        icon = "📄"
+
                     html_content += f"""
                         <div class="file-item">
-                            <div class="file-icon">📄</div>
+                            <input type="checkbox" name="select" value="{html.escape(file_info['name'])}" style="margin-right: 12px">
+                            <div class="file-icon">{icon}</div>
                             <div class="file-info">
                                 <div class="file-name">{file_info['name']}</div>
                                 <div class="file-details">{size_str} • Modified: {file_info['modifiedDate'][:10]}</div>
@@ -474,8 +3336,13 @@ def list_files(directory):
                         </div>
                     """
         
+        if next_link:
+            html_content += f"""
+                    <div class="stats">{next_link}</div>
+            """
+
         html_content += """
-                </div>
+                </form>
             </div>
         </body>
         </html>
@@ -484,9 +3351,7 @@ def list_files(directory):
         return html_content
     
     except Exception as e:
-        print(f"Error listing files in {directory}: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Error listing files in %s", directory)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/files/")
@@ -499,65 +3364,146 @@ def download_file(file_path):
     """Download a specific file from the screenshots folder only"""
     try:
         # Decode the file path
-        import urllib.parse
-        file_path = urllib.parse.unquote(file_path)
-        print(f"Requested file path: {file_path}")
-        
-        # Build the full path within screenshots folder
-        if file_path.startswith("/"):
-            file_path = file_path[1:]  # Remove leading slash
-        
-        full_path = os.path.join(SCREENSHOTS_FOLDER, file_path)
-        
-        # Resolve any symbolic links and normalize the path
-        full_path = os.path.realpath(full_path)
-        screenshots_path = os.path.realpath(SCREENSHOTS_FOLDER)
-        
-        print(f"Screenshots folder: {screenshots_path}")
-        print(f"Full resolved path: {full_path}")
-        
-        # Security check - ensure we're only accessing files within the screenshots folder
-        if not full_path.startswith(screenshots_path):
-            print(f"Access denied: {full_path} is outside {screenshots_path}")
+        file_path = urllib.parse.unquote(file_path).lstrip("/")
+
+        # Security check - only paths within the screenshots folder resolve
+        try:
+            full_path, st, fd = open_screenshot(file_path)
+        except PermissionError:
+            log.warning("Access denied: %s is outside %s", file_path, SCREENSHOTS_FOLDER)
             return jsonify({"error": "Access denied - path outside screenshots folder"}), 403
-        
-        if not os.path.exists(full_path):
-            print(f"File not found: {full_path}")
+        except FileNotFoundError:
+            log.info("File not found: %s", file_path)
             return jsonify({"error": f"File not found: {file_path}"}), 404
-        
-        if os.path.isdir(full_path):
-            print(f"Cannot download directory: {full_path}")
+
+        if stat.S_ISDIR(st.st_mode):
+            os.close(fd)
             return jsonify({"error": "Cannot download directory"}), 400
-        
-        # Check file size to prevent downloading huge files
-        try:
-            file_size = os.path.getsize(full_path)
-            print(f"File size: {file_size} bytes")
-            if file_size > 100 * 1024 * 1024:  # 100MB limit
-                return jsonify({"error": "File too large (max 100MB)"}), 413
-        except OSError as e:
-            print(f"Error getting file size: {e}")
-            return jsonify({"error": "Cannot access file"}), 500
-        
-        directory = os.path.dirname(full_path)
-        filename = os.path.basename(full_path)
-        
-        print(f"Serving file: {filename} from directory: {directory}")
-        
-        # Set proper headers for file download
-        response = send_from_directory(directory, filename, as_attachment=True)
-        response.headers['Content-Length'] = str(file_size)
-        response.headers['Cache-Control'] = 'no-cache'
-        
-        return response
-    
+
+        log_sampled(logging.DEBUG, "serve-file", "Serving file %s", full_path, extra={"bytes": st.st_size})
+        return send_path(full_path, st, fd=fd)
+
     except Exception as e:
-        print(f"Error downloading file {file_path}: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Error downloading file %s", file_path)
         return jsonify({"error": str(e)}), 500
 
+class ZipStream:
+    """Write-only file for ZipFile that hands back whatever was written since
+    the last drain(); ZipFile sees it can't seek and writes data descriptors"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def zip_members(members):
+    """Yield a ZIP archive of (screenshots path, archive name, stat) members
+    in chunks.
+
+    Each member is opened through open_screenshot() only when its turn comes,
+    so a big archive holds one descriptor at a time, and skipped if it's no
+    longer the file that was checked.
+    """
+    out = ZipStream()
+    with zipfile.ZipFile(out, "w") as archive:
+        for rel_path, arcname, st in members:
+            info = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+            info.external_attr = (st.st_mode & 0xFFFF) << 16
+            info.file_size = st.st_size
+            if os.path.splitext(arcname)[1].lower() in ZIP_STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            try:
+                full_path, now_st, fd = open_screenshot(rel_path)
+                if (now_st.st_dev, now_st.st_ino) != (st.st_dev, st.st_ino):
+                    os.close(fd)
+                    raise FileNotFoundError(f"{rel_path} was replaced")
+                with os.fdopen(fd, "rb") as src, \
+                        archive.open(info, "w", force_zip64=st.st_size >= zipfile.ZIP64_LIMIT) as dest:
+                    while True:
+                        chunk = src.read(FILE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        yield out.drain()
+            except OSError as e:
+                # Headers are long gone; leave the member short rather than
+                # abandon the whole archive
+                log.warning("Could not add %s to zip: %s", rel_path, e)
+            yield out.drain()
+    # The central directory, written on close
+    yield out.drain()
+
+@app.route("/download-zip/", defaults={"directory": ""})
+@app.route("/download-zip/<path:directory>")
+def download_zip(directory):
+    """Stream a ZIP of the files in a screenshots directory.
+
+    ?select= (repeatable) picks files by path relative to the directory;
+    without it every file directly in the directory is included.
+    """
+    directory = urllib.parse.unquote(directory).strip("/")
+    try:
+        base, base_st = resolve_screenshot(directory)
+    except PermissionError:
+        return jsonify({"error": "Access denied - path outside screenshots folder"}), 403
+    except FileNotFoundError:
+        return jsonify({"error": f"Directory not found: {directory}"}), 404
+    if not stat.S_ISDIR(base_st.st_mode):
+        return jsonify({"error": "Not a directory"}), 400
+
+    selected = request.args.getlist("select")
+    explicit = bool(selected)
+    if not explicit:
+        entries, _ = cached_listing(base, "name", base_st)
+        selected = [e["name"] for e in entries if not e["isDirectory"]]
+    if len(selected) > ZIP_MAX_FILES:
+        return jsonify({"error": f"Too many files (max {ZIP_MAX_FILES})"}), 413
+
+    # Check every member up front, while an error can still be a status code.
+    # Only files the client named are errors; the whole-folder default just
+    # leaves out entries that escape the folder or vanished since the listing.
+    members = []
+    for name in selected:
+        arcname = os.path.normpath(name.lstrip("/"))
+        # Members stay inside the directory, so archive names never climb out
+        if arcname == ".." or arcname.startswith("../"):
+            return jsonify({"error": f"Access denied: {name}"}), 403
+        rel_path = os.path.join(directory, arcname)
+        try:
+            _, st = resolve_screenshot(rel_path)
+        except PermissionError:
+            if not explicit:
+                continue
+            return jsonify({"error": f"Access denied: {name}"}), 403
+        except FileNotFoundError:
+            if not explicit:
+                continue
+            return jsonify({"error": f"File not found: {name}"}), 404
+        if not stat.S_ISREG(st.st_mode):
+            if not explicit:
+                continue
+            return jsonify({"error": f"Not a file: {name}"}), 400
+        members.append((rel_path, arcname, st))
+
+    archive_name = (os.path.basename(directory) or "screenshots") + ".zip"
+    response = Response(zip_members(members), mimetype="application/zip")
+    response.headers.set("Content-Disposition", "attachment", filename=archive_name)
+    return response
+
 @app.route("/")
+@static_page
 def home():
     return """
     <html>
@@ -582,6 +3528,7 @@ def home():
     """
 
 @app.route("/mp3", methods=["GET"])
+@static_page
 def mp3_page():
     return """
     <!DOCTYPE html>
@@ -631,8 +3578,11 @@ def mp3_page():
             <input type="text" id="yt" name="url" placeholder="https://www.youtube.com/watch?v=..." required />
             <div class="note">The audio will also appear in <em>Music &rarr; Automatically Add to Music</em> on this Mac.</div>
             <button id="go"><span class="btn-text">Download MP3</span></button>
+            <button type="button" id="play">Play now</button>
           </form>
 
+          <audio id="player" controls preload="none" style="width:100%; margin-top:14px; display:none"></audio>
+
           <div id="status" class="status"></div>
 
           <div id="result" class="result">
@@ -665,6 +3615,35 @@ def mp3_page():
           }
         }
 
+        function describeProgress(p) {
+          if (p.stage === 'downloading' && p.percent != null) return 'Downloading… ' + p.percent + '%';
+          if (p.stage === 'postprocessing') return 'Converting to MP3…';
+          if (p.stage === 'importing') return 'Importing into Apple Music…';
+          if (p.stage === 'queued') return 'Waiting in queue…';
+          return 'Starting download…';
+        }
+
+        function waitForJob(eventsUrl) {
+          return new Promise((resolve, reject) => {
+            const events = new EventSource(eventsUrl);
+            events.onmessage = (e) => {
+              const job = JSON.parse(e.data);
+              if (job.state === 'done') { events.close(); resolve(job.result); }
+              else if (job.state === 'error') { events.close(); reject(new Error(job.error || 'Unknown error')); }
+              else showStatus(describeProgress(job.progress), true);
+            };
+          });
+        }
+
+        document.getElementById('play').addEventListener('click', () => {
+          const url = input.value.trim();
+          if (!url) { showStatus('Please paste a YouTube URL.', false); return; }
+          const player = document.getElementById('player');
+          player.src = '/stream/mp3?url=' + encodeURIComponent(url);
+          player.style.display = 'block';
+          player.play();
+        });
+
         function showStatus(msg, ok) {
           statusEl.textContent = msg;
           statusEl.className = 'status ' + (ok ? 'ok' : 'err');
@@ -686,16 +3665,19 @@ def mp3_page():
               body: JSON.stringify({ url })
             });
 
-            const data = await resp.json();
+            const queued = await resp.json();
             if (!resp.ok) {
-              throw new Error(data.error || 'Unknown error');
+              throw new Error(queued.error || 'Unknown error');
             }
 
+            const data = await waitForJob(queued.events_url);
+
             // Success
             fname.textContent = data.file;
             fhref.href = '/file/' + encodeURIComponent(data.file);
+            document.querySelector('#imported em').textContent = data.status;
             result.style.display = 'block';
-            showStatus('Done! File saved and imported to Apple Music.', true);
+            showStatus('Done! File ' + data.status + '.', true);
           } catch (err) {
             console.error(err);
             showStatus('Error: ' + err.message, false);
@@ -709,5 +3691,72 @@ def mp3_page():
     """
 
 
+def serve(bind, workers, threads, preload, timeout, graceful_timeout, keepalive, reload):
+    """Run the app under gunicorn with multiple worker processes.
+
+    Workers import this module as "server" themselves unless preload is on,
+    so a SIGHUP to the master gracefully restarts them on the current code.
+    Preloading forks workers from an already-imported app instead: faster
+    startup and shared memory, but SIGHUP then keeps the old code.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("serve needs gunicorn: pip install gunicorn")
+
+    def post_worker_init(worker):
+        # Pick up jobs interrupted by a restart as soon as the worker is up,
+        # rather than on its first request
+        import server
+        server.ensure_logging()
+        server.resume_jobs()
+
+    class ServerApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", bind)
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            # gthread keeps idle keep-alive connections off the worker threads
+            self.cfg.set("worker_class", "gthread" if threads > 1 else "sync")
+            self.cfg.set("preload_app", preload)
+            self.cfg.set("timeout", timeout)
+            self.cfg.set("graceful_timeout", graceful_timeout)
+            self.cfg.set("keepalive", keepalive)
+            self.cfg.set("reload", reload)
+            self.cfg.set("proc_name", "mp3-conversions-server")
+            self.cfg.set("post_worker_init", post_worker_init)
+
+        def load(self):
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import server
+            return server.app
+
+    if workers > 1:
+        # Workers need to share rate limit buckets to enforce them
+        os.environ.setdefault("RATE_LIMIT_STORE", "sqlite")
+    ServerApplication().run()
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5050) 
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MP3/MP4 conversions server")
+    commands = parser.add_subparsers(dest="command")
+    serve_parser = commands.add_parser("serve", help="production server (gunicorn, multi-process)")
+    serve_parser.add_argument("--bind", default=os.environ.get("BIND", "0.0.0.0:5050"))
+    serve_parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_WORKERS", "2")))
+    serve_parser.add_argument("--threads", type=int, default=int(os.environ.get("WEB_THREADS", "8")))
+    serve_parser.add_argument("--preload", action="store_true", help="import the app once in the master before forking")
+    serve_parser.add_argument("--timeout", type=int, default=120)
+    serve_parser.add_argument("--graceful-timeout", type=int, default=30)
+    serve_parser.add_argument("--keepalive", type=int, default=5)
+    serve_parser.add_argument("--reload", action="store_true", help="restart workers when the code changes")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.bind, args.workers, args.threads, args.preload, args.timeout,
+              args.graceful_timeout, args.keepalive, args.reload)
+    else:
+        ensure_logging()
+        start_janitor()
+        resume_jobs()
+        app.run(host="0.0.0.0", port=5050) 
\ No newline at end of file
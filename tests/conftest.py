@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# server.py creates its folders under ~ at import time, so point HOME at a
+# scratch directory before any test imports it
+os.environ["HOME"] = tempfile.mkdtemp(prefix="mp3server-test-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Stands in for yt-dlp: logs its arguments to $FAKE_YT_DLP_CALLS, prints the
+# [info]/[filepath] lines the server reads and writes a small output file.
+# FAKE_TITLE and FAKE_DELAY (seconds) shape a run.
+FAKE_YT_DLP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake-yt-dlp")
+
+
+@pytest.fixture
+def fake_yt_dlp(tmp_path, monkeypatch):
+    """Point the server at a fake yt-dlp; returns a function counting its runs"""
+    import server
+
+    calls = tmp_path / "calls"
+    calls.touch()
+    monkeypatch.setattr(server, "YT_DLP", FAKE_YT_DLP)
+    monkeypatch.setattr(server, "DOWNLOAD_ENGINE", "subprocess")
+    monkeypatch.setenv("FAKE_YT_DLP_CALLS", str(calls))
+    return lambda: len(calls.read_text().splitlines())
+
+
+@pytest.fixture
+def screenshots(tmp_path, monkeypatch):
+    """A scratch screenshots folder, with rate limiting off"""
+    import server
+
+    folder = tmp_path / "Pictures"
+    folder.mkdir()
+    monkeypatch.setattr(server, "SCREENSHOTS_FOLDER", str(folder))
+    monkeypatch.setattr(server, "_screenshots_root", None)
+    monkeypatch.setattr(server, "RATE_LIMITS", {"cheap": (0, 0), "expensive": (0, 0)})
+    yield folder
+    if server._screenshots_root is not None:
+        os.close(server._screenshots_root[1])
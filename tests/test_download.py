@@ -0,0 +1,111 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import server
+
+
+def video_url():
+    # A fresh id per test, so the media cache never answers for it
+    return "https://youtu.be/" + uuid.uuid4().hex[:11]
+
+
+def finished_job(job_id, timeout=10):
+    deadline = time.time() + timeout
+    while server.get_job(job_id)["state"] not in ("done", "error") and time.time() < deadline:
+        time.sleep(0.05)
+    return server.get_job(job_id)
+
+
+def test_one_yt_dlp_run_per_download(fake_yt_dlp, monkeypatch):
+    monkeypatch.setenv("FAKE_TITLE", 'AC/DC: "Live" at <River> Plate?')
+
+    filename = server.download_audio(video_url())
+
+    assert fake_yt_dlp() == 1
+    assert filename == "AC_DC_ _Live_ at _River_ Plate_.mp3"
+    assert os.path.exists(os.path.join(server.DOWNLOAD_FOLDER, filename))
+
+
+
+def test_concurrent_downloads_share_one_run(fake_yt_dlp, monkeypatch):
+    monkeypatch.setenv("FAKE_DELAY", "0.5")
+    url = video_url()
+    spellings = [url, url.replace("youtu.be/", "www.youtube.com/watch?v="),
+                 url.replace("youtu.be/", "youtube.com/shorts/")]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(server.download_audio, [spellings[i % 3] for i in range(8)]))
+
+    assert fake_yt_dlp() == 1
+    assert len(set(results)) == 1
+
+
+def test_concurrent_submissions_share_one_job(fake_yt_dlp, monkeypatch):
+    monkeypatch.setenv("FAKE_DELAY", "0.5")
+    monkeypatch.setattr(server, "MUSIC_IMPORT_FOLDER", server.STATE_FOLDER)
+    monkeypatch.setattr(server, "DISK_MIN_FREE_BYTES", 0)
+    monkeypatch.setattr(server, "RATE_LIMITS", {"cheap": (0, 0), "expensive": (0, 0)})
+    url = video_url()
+
+    def submit(_):
+        return server.app.test_client().post("/download", json={"url": url}).get_json()["job"]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        job_ids = set(pool.map(submit, range(8)))
+
+    assert len(job_ids) == 1
+    assert finished_job(job_ids.pop())["state"] == "done"
+    assert fake_yt_dlp() == 1
+
+
+def test_batch_rejects_malformed_bodies(fake_yt_dlp, monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMITS", {"cheap": (0, 0), "expensive": (0, 0)})
+    client = server.app.test_client()
+
+    for urls in ([video_url(), 5], [video_url(), ""], [None]):
+        response = client.post("/download/batch", json={"urls": urls})
+        assert response.status_code == 400
+
+    for body in ({"resume": {"id": "x"}}, {"resume": ["x"]}, {"kind": ["audio"], "urls": [video_url()]},
+                 {"playlist": {"url": "x"}}, [video_url()], "resume"):
+        response = client.post("/download/batch", json=body)
+        assert response.status_code == 400
+
+    assert fake_yt_dlp() == 0
+
+
+def test_playlist_urls_download_only_the_video(fake_yt_dlp):
+    url = video_url().replace("youtu.be/", "www.youtube.com/watch?v=")
+
+    server.download_audio(url + "&list=PL" + uuid.uuid4().hex)
+
+    with open(os.environ["FAKE_YT_DLP_CALLS"]) as calls:
+        assert "--no-playlist" in calls.read().split()
+
+
+def test_profiles_music_cant_import_are_only_saved(fake_yt_dlp, monkeypatch):
+    imported = []
+    monkeypatch.setattr(server, "_audio_profile", server.AUDIO_PROFILES["opus"])
+    monkeypatch.setattr(server, "import_to_music", imported.append)
+    monkeypatch.setattr(server, "DISK_MIN_FREE_BYTES", 0)
+    monkeypatch.setattr(server, "RATE_LIMITS", {"cheap": (0, 0), "expensive": (0, 0)})
+
+    job_id = server.app.test_client().post("/download", json={"url": video_url()}).get_json()["job"]
+    job = finished_job(job_id)
+
+    assert job["state"] == "done"
+    assert imported == []
+    assert "imported" not in job["result"]["status"]
+
+
+def test_malformed_download_bodies_are_400(fake_yt_dlp, monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMITS", {"cheap": (0, 0), "expensive": (0, 0)})
+    client = server.app.test_client()
+
+    for body in (["https://youtu.be/x"], "https://youtu.be/x", 5, {"url": 5}, {"url": ["x"]}, {"url": " "}):
+        for route in ("/download", "/download-mp4"):
+            assert client.post(route, json=body).status_code == 400
+
+    assert fake_yt_dlp() == 0
@@ -0,0 +1,97 @@
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import server
+from conftest import FAKE_YT_DLP
+
+
+def insert_job(**fields):
+    now = time.time()
+    job = {
+        "id": uuid.uuid4().hex, "kind": "audio", "key": "test:" + uuid.uuid4().hex,
+        "url": "https://youtu.be/" + uuid.uuid4().hex[:11], "state": "running",
+        "progress": {"stage": "downloading"}, "result": None, "error": None,
+        "created": now, "updated": now, "owner": os.getpid(), "instance": uuid.uuid4().hex,
+    }
+    job.update(fields)
+    server.save_job(job)
+    return job
+
+
+def forget_job(job):
+    with server._jobs_db_lock:
+        with server.jobs_db() as db:
+            db.execute("DELETE FROM jobs WHERE id = ?", (job["id"],))
+
+
+def test_jobs_of_a_dead_instance_with_a_reused_pid_are_claimed():
+    # Same PID as this process, but a token nobody holds a lock for
+    job = insert_job(owner=os.getpid())
+    try:
+        claimed = [j["id"] for j in server.claim_orphaned_jobs()]
+        assert job["id"] in claimed
+        assert server.load_job(job["id"])["instance"] == server.process_instance()
+    finally:
+        forget_job(job)
+
+
+def test_dead_instance_under_a_live_pid_is_not_attached_to():
+    job = insert_job(owner=os.getppid())
+    try:
+        assert server.find_active_job(job["key"]) is None
+    finally:
+        forget_job(job)
+
+
+def test_live_instance_keeps_its_jobs():
+    token = uuid.uuid4().hex
+    os.makedirs(server.INSTANCES_FOLDER, exist_ok=True)
+    holder = subprocess.Popen(
+        [sys.executable, "-c", "import fcntl, sys; f = open(sys.argv[1], 'a'); "
+         "fcntl.flock(f, fcntl.LOCK_EX); print(flush=True); sys.stdin.read()",
+         os.path.join(server.INSTANCES_FOLDER, f"{token}.lock")],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    holder.stdout.readline()
+    job = insert_job(owner=holder.pid, instance=token)
+    try:
+        assert server.find_active_job(job["key"])["id"] == job["id"]
+        assert job["id"] not in [j["id"] for j in server.claim_orphaned_jobs()]
+    finally:
+        holder.stdin.close()
+        holder.wait()
+        forget_job(job)
+
+
+SUBMIT = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+import server
+server.YT_DLP, server.DOWNLOAD_ENGINE = sys.argv[2], "subprocess"
+server.MUSIC_IMPORT_FOLDER = server.STATE_FOLDER
+server.DISK_MIN_FREE_BYTES = 0
+start = float(sys.argv[4])
+time.sleep(max(start - time.time(), 0))
+job = server.submit_job("audio", sys.argv[3])
+print(job["id"], flush=True)
+# The owner stays up until its job is finished
+while job["id"] in server.JOBS and server.get_job(job["id"])["state"] not in ("done", "error"):
+    time.sleep(0.05)
+"""
+
+
+def test_worker_processes_share_one_job(fake_yt_dlp, monkeypatch):
+    monkeypatch.setenv("FAKE_DELAY", "0.5")
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    url = "https://youtu.be/" + uuid.uuid4().hex[:11]
+    start = str(time.time() + 1.5)
+    workers = [subprocess.Popen([sys.executable, "-c", SUBMIT, repo, FAKE_YT_DLP, url, start],
+                                stdout=subprocess.PIPE, text=True)
+               for _ in range(4)]
+    job_ids = {worker.communicate(timeout=30)[0].strip() for worker in workers}
+
+    assert len(job_ids) == 1
+    assert server.load_job(job_ids.pop())["state"] == "done"
+    assert fake_yt_dlp() == 1
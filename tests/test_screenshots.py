@@ -0,0 +1,168 @@
+import io
+import zipfile
+
+import server
+
+
+def zip_names(response):
+    return sorted(zipfile.ZipFile(io.BytesIO(response.get_data())).namelist())
+
+
+def test_whole_folder_zip_skips_escaping_symlinks(screenshots, tmp_path):
+    (screenshots / "a.png").write_bytes(b"a")
+    (tmp_path / "secret.txt").write_text("secret")
+    (screenshots / "leak.txt").symlink_to(tmp_path / "secret.txt")
+
+    response = server.app.test_client().get("/download-zip/")
+
+    assert response.status_code == 200
+    assert zip_names(response) == ["a.png"]
+
+
+def test_selected_escaping_symlink_is_denied(screenshots, tmp_path):
+    (tmp_path / "secret.txt").write_text("secret")
+    (screenshots / "leak.txt").symlink_to(tmp_path / "secret.txt")
+
+    response = server.app.test_client().get("/download-zip/?select=leak.txt")
+
+    assert response.status_code == 403
+
+
+def test_listing_escapes_selection_values(screenshots):
+    (screenshots / "shots").mkdir()
+    (screenshots / "shots" / 'x"><b>.png').write_bytes(b"x")
+
+    page = server.app.test_client().get("/files/shots").get_data(as_text=True)
+
+    assert 'value="x&quot;&gt;&lt;b&gt;.png"' in page
+
+
+def test_listing_rejects_foreign_cursors(screenshots):
+    (screenshots / "shots").mkdir()
+    for name in ("a.png", "b.png", "c.png"):
+        (screenshots / "shots" / name).write_bytes(b"x")
+    client = server.app.test_client()
+
+    page = client.get("/files/shots?format=json&sort=size&limit=1").get_json()
+    assert page["nextCursor"]
+
+    for cursor in (page["nextCursor"], server.encode_cursor([5]), "NQ", "!!"):
+        response = client.get(f"/files/shots?format=json&sort=name&cursor={cursor}")
+        assert response.status_code == 400
+
+    response = client.get(f"/files/shots?format=json&sort=size&cursor={page['nextCursor']}")
+    assert response.status_code == 200
+
+
+def test_listing_leaves_out_symlinks(screenshots, tmp_path):
+    (screenshots / "shots").mkdir()
+    (screenshots / "shots" / "a.png").write_bytes(b"a")
+    (tmp_path / "secret.txt").write_text("secret")
+    (screenshots / "shots" / "leak.txt").symlink_to(tmp_path / "secret.txt")
+    (screenshots / "shots" / "alias.png").symlink_to(screenshots / "shots" / "a.png")
+
+    page = server.app.test_client().get("/files/shots?format=json").get_json()
+
+    assert [f["name"] for f in page["items"]] == ["a.png"]
+
+
+def test_thumbnail_revalidates_to_304(screenshots):
+    from PIL import Image
+
+    Image.new("RGB", (64, 48), "red").save(screenshots / "red.png")
+    client = server.app.test_client()
+
+    first = client.get("/thumb/red.png?size=128&format=jpeg")
+    assert first.status_code == 200
+    assert "immutable" in first.headers["Cache-Control"]
+    etag = first.headers["ETag"]
+
+    again = client.get("/thumb/red.png?size=128&format=jpeg", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+
+
+def test_zip_skips_a_member_swapped_for_a_symlink(screenshots, tmp_path):
+    (screenshots / "a.png").write_bytes(b"a")
+    (screenshots / "b.png").write_bytes(b"b")
+    (tmp_path / "secret.txt").write_text("secret")
+
+    response = server.app.test_client().get("/download-zip/", buffered=False)
+    # Checked, but not yet streamed
+    (screenshots / "b.png").unlink()
+    (screenshots / "b.png").symlink_to(tmp_path / "secret.txt")
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(response.response)))
+
+    assert archive.namelist() == ["a.png"]
+    assert archive.read("a.png") == b"a"
+
+
+def test_a_page_of_thumbnails_is_not_rate_limited(screenshots, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.setattr(server, "RATE_LIMITS", {"cheap": (20, 100), "expensive": (0.2, 10)})
+    monkeypatch.setattr(server, "_buckets", {})
+    Image.new("RGB", (8, 8), "blue").save(screenshots / "blue.png")
+    client = server.app.test_client()
+
+    statuses = {client.get("/thumb/blue.png?size=128&format=jpeg").status_code
+                for _ in range(server.LISTING_PAGE_SIZE)}
+
+    assert statuses == {200}
+
+
+def test_download_file_serves_byte_ranges(screenshots):
+    (screenshots / "clip.bin").write_bytes(bytes(range(256)) * 4)
+    client = server.app.test_client()
+
+    response = client.get("/download-file/clip.bin", headers={"Range": "bytes=10-19"})
+
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 10-19/1024"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.get_data() == bytes(range(10, 20))
+
+    suffix = client.get("/download-file/clip.bin", headers={"Range": "bytes=-4"})
+    assert suffix.status_code == 206
+    assert suffix.get_data() == bytes(range(252, 256))
+
+
+def test_unsatisfiable_range_is_416(screenshots):
+    (screenshots / "clip.bin").write_bytes(b"x" * 100)
+
+    response = server.app.test_client().get("/download-file/clip.bin", headers={"Range": "bytes=500-600"})
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */100"
+
+
+def test_if_none_match_revalidates_to_304(screenshots):
+    (screenshots / "a.png").write_bytes(b"png")
+    client = server.app.test_client()
+
+    etag = client.get("/download-file/a.png").headers["ETag"]
+    response = client.get("/download-file/a.png", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+    # A rewrite changes the ETag, so the old one no longer matches
+    (screenshots / "a.png").write_bytes(b"png, edited")
+    response = client.get("/download-file/a.png", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_if_range_with_a_stale_etag_sends_the_whole_file(screenshots):
+    (screenshots / "clip.bin").write_bytes(b"0123456789")
+    client = server.app.test_client()
+    etag = client.get("/download-file/clip.bin").headers["ETag"]
+
+    current = client.get("/download-file/clip.bin", headers={"Range": "bytes=2-4", "If-Range": etag})
+    assert current.status_code == 206
+    assert current.get_data() == b"234"
+
+    (screenshots / "clip.bin").write_bytes(b"abcdefghijk")
+    stale = client.get("/download-file/clip.bin", headers={"Range": "bytes=2-4", "If-Range": etag})
+    assert stale.status_code == 200
+    assert stale.get_data() == b"abcdefghijk"
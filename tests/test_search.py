@@ -0,0 +1,31 @@
+import threading
+
+import server
+
+
+def test_search_rejects_cursors_that_are_not_offsets(monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMITS", {"cheap": (0, 0), "expensive": (0, 0)})
+    client = server.app.test_client()
+
+    for key in (["x"], [-1], [True], [1.5], []):
+        response = client.get(f"/search?q=song&cursor={server.encode_cursor(key)}")
+        assert response.status_code == 400
+
+
+def test_failed_catch_up_scan_leaves_the_indexer_running(monkeypatch):
+    scans = []
+
+    def denied():
+        scans.append(threading.current_thread().name)
+        raise PermissionError("Operation not permitted: ~/Pictures")
+
+    monkeypatch.setattr(server, "RATE_LIMITS", {"cheap": (0, 0), "expensive": (0, 0)})
+    monkeypatch.setattr(server, "update_search_index", denied)
+    monkeypatch.setattr(server, "_search_indexer_started", False)
+    monkeypatch.setattr(server, "_search_caught_up", threading.Event())
+
+    response = server.app.test_client().get("/search?q=song")
+
+    assert response.status_code == 200
+    assert scans == ["search-indexer"]
+    assert any(t.name == "search-indexer" and t.is_alive() for t in threading.enumerate())
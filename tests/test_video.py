@@ -0,0 +1,47 @@
+import subprocess
+import sys
+import threading
+
+import server
+
+HOLD_SLOTS = """
+import fcntl, os, sys
+folder, count = sys.argv[1], int(sys.argv[2])
+held = []
+for i in range(count):
+    f = open(os.path.join(folder, f"{i}.lock"), "a")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    held.append(f)
+print(flush=True)
+sys.stdin.read()
+"""
+
+
+def test_connection_limit_is_shared_between_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "MAX_CONNECTIONS", 4)
+    monkeypatch.setattr(server, "CONNECTIONS_FOLDER", str(tmp_path))
+    other = subprocess.Popen([sys.executable, "-c", HOLD_SLOTS, str(tmp_path), "3"],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    other.stdout.readline()
+    try:
+        slots = server.acquire_connections(8)
+        assert len(slots) == 1
+
+        # Everything is taken: the next download waits for a release
+        waiter = []
+        thread = threading.Thread(target=lambda: waiter.append(server.acquire_connections(2)))
+        thread.start()
+        thread.join(0.3)
+        assert not waiter
+        server.release_connections(slots)
+        thread.join(5)
+        assert len(waiter[0]) == 1
+        server.release_connections(waiter[0])
+    finally:
+        other.stdin.close()
+        other.wait()
+
+    # The other process exiting frees its slots
+    slots = server.acquire_connections(8)
+    assert len(slots) == 4
+    server.release_connections(slots)